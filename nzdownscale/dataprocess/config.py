@@ -30,7 +30,7 @@ VAR_STATIONS = {
             },
             '10m_u_component_of_wind': {
                 'subdir': 'Surface_Wind', 
-                'var_name': 'u', # not actually in files - created in stations.ProcessStations.get_wind_components
+                'var_name': 'u', # not actually in files - created in stations.ProcessStations.get_wind_components, stored in the station store
             },
             '10m_v_component_of_wind': {
                 'subdir': 'Surface_Wind',
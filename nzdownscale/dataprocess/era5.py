@@ -1,19 +1,63 @@
 import os
+import re
+import hashlib
 from typing import Literal, List
 import glob
+import numpy as np
 import pandas as pd
 import xarray as xr
-from datetime import datetime
+import zarr
+from tqdm import tqdm
 
-from nzdownscale.dataprocess.utils import DataProcess
+from nzdownscale.dataprocess.utils import DataProcess, FileIndex, DATASET_POOL
+from nzdownscale.dataprocess.regrid import get_regridder, regrid_parallel
 from nzdownscale.dataprocess.config import VARIABLE_OPTIONS, VAR_ERA5
 from nzdownscale.dataprocess.config_local import DATA_PATHS
 
 
+def get_zarr_path() -> str:
+    """ ERA5 Zarr store, DATA_PATHS['era5']['zarr'] or a subfolder of DATA_PATHS['cache'] """
+    if 'zarr' in DATA_PATHS['era5'].keys():
+        return DATA_PATHS['era5']['zarr']
+    if 'cache' in DATA_PATHS.keys():
+        return f'{DATA_PATHS["cache"]}/era5/era5.zarr'
+    raise ValueError("Please set 'zarr' in DATA_PATHS['era5'] or a 'cache' path in DATA_PATHS dict e.g. 'cache':'data/.datacache'")
+
+
+def get_pyramid_path() -> str:
+    """ Zarr store of coarsened ERA5 levels, DATA_PATHS['era5']['pyramid'] or a subfolder of DATA_PATHS['cache'] """
+    if 'pyramid' in DATA_PATHS['era5'].keys():
+        return DATA_PATHS['era5']['pyramid']
+    if 'cache' in DATA_PATHS.keys():
+        return f'{DATA_PATHS["cache"]}/era5/pyramid.zarr'
+    return None
+
+
 class ProcessERA5(DataProcess):
 
-    def __init__(self) -> None:
+    def __init__(self,
+                 n_workers: int = 1,
+                 use_pool: bool = True,
+                 use_zarr: bool = True,
+                 ) -> None:
+        """
+        Args:
+            n_workers (int): number of worker processes used to index new or changed ERA5 files
+            use_pool (bool): load_ds_time reuses open datasets from the process-wide DATASET_POOL
+            use_zarr (bool): read from the ERA5 Zarr store (see build_zarr_store) when it has the variable
+        """
         super().__init__()
+        self.n_workers = n_workers
+        self.use_pool = use_pool
+        self.use_zarr = use_zarr
+        self._catalogs = {}
+
+
+    def __getstate__(self):
+        # catalogs are reloaded from disk in worker processes
+        state = self.__dict__.copy()
+        state['_catalogs'] = {}
+        return state
 
 
     def load_ds(self, 
@@ -36,9 +80,89 @@ class ProcessERA5(DataProcess):
                 years = [years[0]]
         else:
             ValueError (f'Years should be int, str or list, not {type(years)}')
+        if self._zarr_available(var):
+            ds = self.open_zarr(var)
+            if years is not None:
+                ds = ds.sel(time=ds['time'].dt.year.isin(years))
+            return ds
         filenames = self.get_filenames(var, years)
         return xr.open_mfdataset(filenames)
 
+
+    def build_zarr_store(self,
+                         variables: List[str] = None,
+                         time_chunk: int = 24,
+                         ) -> str:
+        """
+        Convert ERA5 netCDF files into a consolidated Zarr store, one group per variable (named by subdir).
+        Chunks are time-major with the whole NZ grid in each chunk, so reading one timestamp reads a single chunk.
+        expver is resolved as in load_ds_time. Once built, ERA5 loads read from the store.
+        Args:
+            variables (list): variables to convert, all of VAR_ERA5 if None
+            time_chunk (int): number of timesteps per chunk
+        Returns:
+            str: path of the Zarr store
+        """
+        path = get_zarr_path()
+        if variables is None:
+            variables = list(VAR_ERA5.keys())
+        for var in variables:
+            group = VAR_ERA5[var]['subdir']
+            n_written, last_time = 0, None
+            for filename in tqdm(list(self.get_catalog(var).index), desc=f'Writing {group} to zarr'):
+                with xr.open_dataset(filename) as ds:
+                    ds = self._select_expver(ds).sortby('time')
+                    if last_time is not None:
+                        # files can overlap at their boundaries
+                        ds = ds.sel(time=ds['time'] > last_time)
+                    if ds.sizes['time'] == 0:
+                        continue
+                    for name in ds.variables:
+                        ds[name].encoding = {}
+                    # align dask chunks with the partially filled last chunk in the store
+                    offset = (time_chunk - n_written % time_chunk) % time_chunk
+                    n_time = ds.sizes['time']
+                    chunks = ([min(offset, n_time)] if offset > 0 else []) + \
+                             [time_chunk] * ((n_time - min(offset, n_time)) // time_chunk)
+                    if sum(chunks) < n_time:
+                        chunks.append(n_time - sum(chunks))
+                    ds = ds.chunk({'time': tuple(chunks), 'latitude': -1, 'longitude': -1})
+                    if n_written == 0:
+                        ds.to_zarr(path, group=group, mode='w', consolidated=False, 
+                                   encoding={name: {'chunks': (time_chunk,) + ds[name].shape[1:]} 
+                                             for name in ds.data_vars if ds[name].dims[0] == 'time'})
+                    else:
+                        # each zarr chunk is written by exactly one dask chunk (see offset above), 
+                        # xarray's check doesn't account for the offset of an append
+                        ds.to_zarr(path, group=group, append_dim='time', consolidated=False, safe_chunks=False)
+                    n_written += n_time
+                    last_time = ds['time'].values[-1]
+            zarr.open_group(path, mode='a', path=group).attrs['complete'] = True
+        zarr.consolidate_metadata(path)
+        return path
+
+
+    def _zarr_available(self, var) -> bool:
+        if not self.use_zarr:
+            return False
+        try:
+            path = get_zarr_path()
+        except ValueError:
+            return False
+        if not os.path.exists(f'{path}/{VAR_ERA5[var]["subdir"]}'):
+            return False
+        return zarr.open_group(path, mode='r', path=VAR_ERA5[var]['subdir']).attrs.get('complete', False)
+
+
+    def open_zarr(self,
+                  var: Literal[tuple(VARIABLE_OPTIONS)],
+                  ) -> xr.Dataset:
+        """ Lazy dataset of variable var from the ERA5 Zarr store """
+        open_fn = lambda: xr.open_zarr(get_zarr_path(), group=VAR_ERA5[var]['subdir'], consolidated=True)
+        if self.use_pool:
+            return DATASET_POOL.get(('era5_zarr', var), open_fn)
+        return open_fn()
+
     
     def ds_to_da(self,
                  ds: xr.Dataset,
@@ -57,24 +181,83 @@ class ProcessERA5(DataProcess):
         return da
 
 
-    def convert_hourly_to_daily(self, 
-                                ds, 
-                                function:Literal['mean', 'sum']='mean'):
-        if function == 'mean':
-            ds = ds.resample(time='D').mean()
-        elif function == 'sum':
-            ds = ds.resample(time='D').sum()
-        else:
-            raise ValueError(f'function={function} not recognised')
-        # ! below line causes error in convNP run
-        #ds['time'] = ds['time'].dt.strftime('%Y-%m-%d')
-        return ds
-    
-
     def coarsen_da(self, da: xr.DataArray, coarsen_by: int, boundary: str = 'trim'):
         return super().coarsen_da(da, coarsen_by, boundary)
 
 
+    def coarsen_ds_cached(self,
+                          ds: xr.Dataset,
+                          coarsen_by: int,
+                          tag: str = 'hourly',
+                          ) -> xr.Dataset:
+        """
+        coarsen_da of every variable in ds, through a multi-resolution pyramid persisted as Zarr (see get_pyramid_path).
+        Each level is computed lazily, the first time it is asked for, per data variable, year and coarsen factor, 
+        straight from ds so results are identical to coarsen_da. Later runs with the same factor read the level back,
+        unless the coordinates or the source ERA5 files of the level (mtime and size) changed.
+        Args:
+            ds (xr.Dataset): ERA5 data with time, latitude and longitude
+            coarsen_by (int): coarsen factor
+            tag (str): describes how ds was derived from the raw ERA5 files (e.g. 'hourly' or 'daily_mean'), 
+                part of the cache key
+        """
+        path = get_pyramid_path()
+        if coarsen_by == 1 or path is None:
+            return self.coarsen_da(ds, coarsen_by)
+
+        ds_levels = []
+        for name in ds.data_vars:
+            da_years = []
+            for year in np.unique(ds['time'].dt.year.values):
+                da_year = ds[name].sel(time=ds['time'].dt.year == year)
+                group = f'{name}/{tag}/x{coarsen_by}/{year}'
+                digest = self._source_digest(da_year, self._source_files(name, year))
+                if not self._pyramid_level_valid(path, group, digest):
+                    da_coarse = self.coarsen_da(da_year, coarsen_by).chunk({'time': 24, 'latitude': -1, 'longitude': -1})
+                    ds_coarse = da_coarse.to_dataset(name=name)
+                    for var_name in ds_coarse.variables:
+                        ds_coarse[var_name].encoding = {}
+                    ds_coarse.to_zarr(path, group=group, mode='w', consolidated=False)
+                    zarr.open_group(path, mode='a', path=group).attrs['source_digest'] = digest
+                da_years.append(xr.open_zarr(path, group=group, consolidated=False)[name])
+            ds_levels.append(xr.concat(da_years, dim='time') if len(da_years) > 1 else da_years[0])
+        return xr.merge(ds_levels).assign_attrs(ds.attrs)
+
+
+    def _source_digest(self, da: xr.DataArray, source_files: list = ()) -> str:
+        """ 
+        Digest of the time, latitude and longitude of da and of the (filepath, mtime, size) of its source files,
+        identifies the source of a pyramid level 
+        """
+        h = hashlib.sha1()
+        for dim in ['time', 'latitude', 'longitude']:
+            h.update(np.ascontiguousarray(da[dim].values).tobytes())
+        h.update(repr(list(source_files)).encode())
+        return h.hexdigest()
+
+
+    def _source_files(self, name: str, year: int) -> list:
+        """ 
+        (filepath, mtime, size) of the ERA5 files of data variable name overlapping year, 
+        empty if name is not an ERA5 variable (e.g. derived) or has no files 
+        """
+        var = next((var for var, info in VAR_ERA5.items() if info['var_name'] == name), None)
+        if var is None:
+            return []
+        try:
+            filenames = self.get_filenames(var, [int(year)])
+        except ValueError:
+            return []
+        stats = {filepath: os.stat(filepath) for filepath in sorted(filenames)}
+        return [(filepath, st.st_mtime, st.st_size) for filepath, st in stats.items()]
+
+
+    def _pyramid_level_valid(self, path, group, digest) -> bool:
+        if not os.path.exists(f'{path}/{group}'):
+            return False
+        return zarr.open_group(path, mode='r', path=group).attrs.get('source_digest') == digest
+
+
     def get_parent_path(self,
                         var: Literal[tuple(VARIABLE_OPTIONS)],
                         ):
@@ -87,11 +270,118 @@ class ProcessERA5(DataProcess):
         return f'{DATA_PATHS["era5"][parent]}/{VAR_ERA5[var]["subdir"]}'
     
 
+    def get_catalog(self,
+                    var: Literal[tuple(VARIABLE_OPTIONS)],
+                    use_cache: bool = True,
+                    ) -> pd.DataFrame:
+        """
+        Catalog of the ERA5 files of variable var, indexed by filepath and sorted by time:
+        start_time, end_time, n_times and grid (n_lat, n_lon, min/max lat and lon).
+        Only files that are new or whose mtime or size changed are opened to refresh it.
+        Kept on disk in DATA_PATHS['cache'] if set (and use_cache=True), otherwise in memory.
+        """
+        subdir = VAR_ERA5[var]['subdir']
+        if use_cache and 'cache' in DATA_PATHS.keys():
+            filepath = f'{DATA_PATHS["cache"]}/era5/catalog_{subdir}.pkl'
+        else:
+            filepath = None
+        if (subdir, filepath) not in self._catalogs:
+            self._catalogs[(subdir, filepath)] = FileIndex(filepath)
+        df = self._catalogs[(subdir, filepath)].refresh(self.find_filenames(var),
+                                                        self._read_file_info,
+                                                        desc=f'Indexing ERA5 {subdir} files',
+                                                        n_workers=self.n_workers,
+                                                        use_processes=True)
+        if len(df) == 0:
+            raise ValueError(f'No ERA5 files found for {var} in {self.get_parent_path(var)}')
+        return df.sort_values('start_time')
+
+
+    def _read_file_info(self,
+                        filepath: str,
+                        ) -> dict:
+        with xr.open_dataset(filepath) as ds:
+            time = ds['time'].values
+            lat, lon = ds['latitude'].values, ds['longitude'].values
+            return {
+                'start_time': pd.Timestamp(time.min()),
+                'end_time': pd.Timestamp(time.max()),
+                'n_times': len(np.unique(time)),
+                'n_lat': len(lat),
+                'n_lon': len(lon),
+                'minlat': float(lat.min()),
+                'maxlat': float(lat.max()),
+                'minlon': float(lon.min()),
+                'maxlon': float(lon.max()),
+                }
+
+
     def get_filenames(self,
                       var: Literal[tuple(VARIABLE_OPTIONS)],
                       years: List=None,
                       ) -> List[str]:
-        """ Get list of ERA5 filenames for variable and list of years (if specified) """ 
+        """ Get list of ERA5 filenames for variable and list of years (if specified), from the file catalog """ 
+        df = self._file_times(var)
+        if years is not None:
+            years = [int(year) for year in years]
+            start_years, end_years = df['start_time'].dt.year.values, df['end_time'].dt.year.values
+            overlaps = np.zeros(len(df), dtype=bool)
+            for year in years:
+                overlaps |= (start_years <= year) & (end_years >= year)
+            df = df[overlaps]
+        return list(df.index)
+
+
+    def get_filenames_time(self,
+                           var: Literal[tuple(VARIABLE_OPTIONS)],
+                           time,
+                           ) -> List[str]:
+        """ ERA5 filenames whose time range contains at least one of time (from the file catalog) """
+        times = np.sort(pd.DatetimeIndex(np.atleast_1d(time)).values)
+        df = self._file_times(var)
+        # first requested time at or after each file start, if any is within the file
+        pos = np.searchsorted(times, df['start_time'].values)
+        inside = (pos < len(times)) & (times[np.minimum(pos, len(times) - 1)] <= df['end_time'].values)
+        return list(df.index[inside])
+
+
+    def _file_times(self,
+                    var: Literal[tuple(VARIABLE_OPTIONS)],
+                    ) -> pd.DataFrame:
+        """
+        start_time and end_time of the ERA5 files of variable var, indexed by filepath and sorted by time.
+        From the catalog if it is kept on disk. Otherwise building it would open every file in each new process, 
+        so the times are parsed from the filenames (e.g. ..._200001.nc or ..._2000.nc), 
+        and the files are only opened if some filename has no date.
+        """
+        if 'cache' in DATA_PATHS.keys():
+            return self.get_catalog(var)
+        ranges = {filepath: self._filename_time_range(filepath) for filepath in self.find_filenames(var)}
+        if len(ranges) == 0:
+            raise ValueError(f'No ERA5 files found for {var} in {self.get_parent_path(var)}')
+        if any(time_range is None for time_range in ranges.values()):
+            return self.get_catalog(var)
+        df = pd.DataFrame.from_dict(ranges, orient='index', columns=['start_time', 'end_time'])
+        return df.sort_values('start_time')
+
+
+    def _filename_time_range(self, 
+                             filepath: str,
+                             ) -> tuple:
+        """ (start_time, end_time) of the month or year in the filename e.g. ..._200001.nc or ..._2000.nc, None if none """
+        match = re.search(r'_(\d{4})(\d{2})?\.nc$', os.path.basename(filepath))
+        if match is None:
+            return None
+        year, month = match.groups()
+        period = pd.Period(year, 'Y') if month is None else pd.Period(f'{year}-{month}', 'M')
+        return period.start_time, period.end_time
+
+
+    def find_filenames(self,
+                       var: Literal[tuple(VARIABLE_OPTIONS)],
+                       years: List=None,
+                       ) -> List[str]:
+        """ Find ERA5 files for variable and list of years (if specified) in the folder layout of the variable """ 
 
         parent_path = self.get_parent_path(var)
         
@@ -126,24 +416,68 @@ class ProcessERA5(DataProcess):
             var (str): variable
             time: datetime obj
                     """
-        if isinstance(time, datetime):
-            year = [time.year]
-        elif isinstance(time, (list, pd.DatetimeIndex)):
-            year = set(t.year for t in time)
-        filenames = self.get_filenames(var, year)
-        ds = xr.open_mfdataset(filenames)
+        return self._open_ds_time(var, time).load()
+
+
+    def _open_ds_time(self, var, time) -> xr.Dataset:
+        """ Lazy load_ds_time """
+        if self._zarr_available(var):
+            return self.open_zarr(var).sel(time=time)
+
+        # only open the files that contain the requested times
+        filenames = self.get_filenames_time(var, time)
+        if self.use_pool:
+            ds = DATASET_POOL.open_mfdataset(('era5', var), filenames)
+        else:
+            ds = xr.open_mfdataset(filenames)
+        ds = self._select_expver(ds)
+        return ds.sel(time=time)
+
+
+    def load_ds_variables(self,
+                          variables: List[str],
+                          years: List = None,
+                          time = None,
+                          load: bool = None,
+                          ) -> xr.Dataset:
+        """
+        Load several variables into one dataset, aligned on time, latitude and longitude and merged once.
+        The variables are opened lazily and read together in a single dask compute, 
+        so their chunks are read concurrently rather than one variable after another.
+        Args:
+            variables (list): variables
+            years (list): specific years as in load_ds, used if time is None
+            time: times as in load_ds_time
+            load (bool): load into memory, defaults to True if time is given (as load_ds_time) and False otherwise (as load_ds)
+        """
+        if load is None:
+            load = time is not None
+        ds_list = []
+        for var in dict.fromkeys(variables):
+            if time is None:
+                ds = self._select_expver(self.load_ds(var, years))
+            else:
+                ds = self._open_ds_time(var, time)
+            ds_list.append(ds)
+        ds = xr.merge(ds_list)
+        if load:
+            ds = ds.load()
+        return ds
+
+
+    def _select_expver(self, ds: xr.Dataset) -> xr.Dataset:
+        """ Keep expver 1 where the data has an expver coordinate """
         if 'expver' in list(ds.coords):
             ds = ds.sel(expver=1)
             ds = ds.drop('expver')
-        return ds.sel(time=time).load()
+        return ds
 
 
     def kelvin_to_celsius(self, da: xr.DataArray):
         return da - 273.15
     
-import xesmf as xe
-def interpolate_era5(era5, ds, var):
-    "Interpolate ERA5 to match the resolution of ds"
+def interpolate_era5(era5, ds, var, n_workers=1):
+    "Interpolate ERA5 to match the resolution of ds, n_workers threads regrid chunks of the time axis in parallel"
     era5_var = VAR_ERA5[var]['var_name']
     if type(era5) is xr.Dataset:
         era5 = era5[era5_var]
@@ -153,28 +487,8 @@ def interpolate_era5(era5, ds, var):
         'longitude': (['longitude'], ds.longitude.values),
     })
 
-    # method = 'bilinear'
-    # Ny_in, Nx_in = len(era5.latitude), len(era5.longitude)
-    # Ny_out, Nx_out = len(ds.latitude), len(ds.longitude)
-    # filename = f'{method}_{Ny_in}x{Nx_in}_{Ny_out}x{Nx_out}.nc'
-    # filepath = os.path.join(DATA_PATHS['regridder_weights']['parent'], filename)
-    # if os.path.exists(filepath):
-    #     regridder = xe.Regridder(hold.isel(Time=0), 
-    #                                 ds_out, 
-    #                                 'bilinear', 
-    #                                 reuse_weights=True,
-    #                                 filename=filepath
-    #                                 )
-    # else:
-    regridder = xe.Regridder(era5.isel(time=0), 
-                            ds_out, 
-                            'bilinear', 
-                            reuse_weights=False,
-                            # filename=filepath
-                            )
-    # regridder.to_netcdf(filepath)
-    
-    interp_hold = regridder(era5)
+    regridder = get_regridder(era5.isel(time=0), ds_out, 'bilinear')
+    interp_hold = regrid_parallel(regridder, era5, dim='time', n_workers=n_workers)
     return interp_hold
 
 
@@ -0,0 +1,294 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import xarray as xr
+from scipy import sparse
+from scipy.spatial import Delaunay
+
+try:
+    import xesmf as xe
+except ImportError:
+    # the barycentric regridder works without xesmf
+    xe = None
+
+from nzdownscale.dataprocess.config_local import DATA_PATHS
+
+
+LAT_NAMES = ['latitude', 'lat', 'XLAT']
+LON_NAMES = ['longitude', 'lon', 'XLONG']
+
+
+def get_weights_dir() -> str:
+    """ Directory for regridding weight files, DATA_PATHS['regridder_weights']['parent'] or None if not set """
+    if 'regridder_weights' in DATA_PATHS.keys():
+        return DATA_PATHS['regridder_weights']['parent']
+    return None
+
+
+def _latlon(ds):
+    """ Latitude and longitude arrays of a dataset or data array """
+    lat = next((ds[name] for name in LAT_NAMES if name in ds.coords or name in ds.variables), None)
+    lon = next((ds[name] for name in LON_NAMES if name in ds.coords or name in ds.variables), None)
+    if lat is None or lon is None:
+        raise ValueError(f'No latitude/longitude found, expected one of {LAT_NAMES} and {LON_NAMES}')
+    return lat.values, lon.values
+
+
+def _latlon_2d(ds):
+    """ Latitude and longitude of every grid point, 1D coordinates are expanded to the full grid """
+    lat, lon = _latlon(ds)
+    if lat.ndim == 1 and lon.ndim == 1:
+        lon, lat = np.meshgrid(lon, lat)
+    return lat, lon
+
+
+def grid_digest(ds_in, ds_out, method: str) -> str:
+    """ Digest of the source and target latitude/longitude arrays and method, identifies a set of weights """
+    h = hashlib.sha1(method.encode())
+    for ds in [ds_in, ds_out]:
+        for values in _latlon(ds):
+            values = np.ascontiguousarray(values)
+            h.update(str((values.shape, values.dtype.str)).encode())
+            h.update(values.tobytes())
+    return h.hexdigest()
+
+
+def regrid_time_parallel(regrid_chunk,
+                         n_times: int,
+                         n_workers: int = 1,
+                         chunk_size: int = 24,
+                         ) -> None:
+    """
+    Call regrid_chunk(time_slice) for consecutive chunks of chunk_size timesteps, across a pool of 
+    n_workers threads (serially if 1). regrid_chunk writes its chunk into a preallocated output, 
+    so chunks are never concatenated. The sparse products release the GIL, so threads scale 
+    with n_workers without copying the weights or the data to other processes.
+    """
+    slices = [slice(start, min(start + chunk_size, n_times)) for start in range(0, n_times, chunk_size)]
+    if n_workers is None or n_workers <= 1:
+        for sl in slices:
+            regrid_chunk(sl)
+    else:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            # list() raises any exception from the workers
+            list(executor.map(regrid_chunk, slices))
+
+
+def regrid_parallel(regridder,
+                    ds,
+                    dim: str = 'time',
+                    n_workers: int = 1,
+                    chunk_size: int = 24,
+                    ):
+    """
+    Apply an xESMF regridder to ds in chunks along dim, see regrid_time_parallel
+    Args:
+        regridder (xe.Regridder): e.g. from get_regridder
+        ds (xr.Dataset or xr.DataArray): data to regrid, with dimension dim
+        dim (str): time dimension to split, e.g. 'time' for ERA5 or 'Time' for WRF
+        n_workers (int): number of threads
+        chunk_size (int): timesteps per chunk
+    Returns:
+        ds: same as regridder(ds)
+    """
+    if n_workers is None or n_workers <= 1:
+        return regridder(ds)
+
+    is_da = isinstance(ds, xr.DataArray)
+    if is_da:
+        name = ds.name if ds.name is not None else '__xarray_dataarray_variable__'
+        ds = ds.to_dataset(name=name)
+
+    n_times = ds.sizes[dim]
+    template = regridder(ds.isel({dim: slice(0, 1)}))
+    out = {}
+    for var, da in template.data_vars.items():
+        if dim in da.dims:
+            shape = tuple(n_times if d == dim else size for d, size in zip(da.dims, da.shape))
+            out[var] = np.empty(shape, dtype=da.dtype)
+
+    def regrid_chunk(sl):
+        ds_chunk = regridder(ds.isel({dim: sl}))
+        for var, values in out.items():
+            axis = template[var].dims.index(dim)
+            values[(slice(None),) * axis + (sl,)] = ds_chunk[var].values
+
+    regrid_time_parallel(regrid_chunk, n_times, n_workers=n_workers, chunk_size=chunk_size)
+
+    coords = {name: (ds.coords[name] if dim in coord.dims else coord) for name, coord in template.coords.items()}
+    ds_out = xr.Dataset({var: (da.dims, out[var], da.attrs) if var in out else da 
+                         for var, da in template.data_vars.items()},
+                        coords=coords, attrs=template.attrs)
+    return ds_out[name] if is_da else ds_out
+
+
+class BarycentricRegridder:
+    """
+    Linear interpolation on the Delaunay triangulation of the source grid points, the same result as
+    scipy's LinearNDInterpolator. The triangulation and barycentric weights are computed once and kept 
+    as a sparse (target points x source points) matrix, which is applied to every variable and 
+    timestep in one sparse-dense product. Targets outside the source grid are NaN.
+    """
+
+    def __init__(self,
+                 weights: sparse.csr_matrix,
+                 outside: np.ndarray,
+                 ) -> None:
+        """
+        Args:
+            weights (sparse.csr_matrix): (n_target, n_source) barycentric weights
+            outside (np.ndarray): bool, shape of the target grid, True outside the source grid
+        """
+        self.weights = weights
+        self.outside = outside
+
+
+    @classmethod
+    def from_grids(cls,
+                   ds_in,
+                   ds_out,
+                   ) -> 'BarycentricRegridder':
+        """ Triangulate the grid of ds_in and compute the weights of every point of the grid of ds_out """
+        lat_in, lon_in = _latlon_2d(ds_in)
+        lat_out, lon_out = _latlon_2d(ds_out)
+        tri = Delaunay(np.column_stack([lon_in.ravel(), lat_in.ravel()]))
+        points = np.column_stack([lon_out.ravel(), lat_out.ravel()])
+
+        simplex = tri.find_simplex(points)
+        inside = simplex >= 0
+        transform = tri.transform[simplex[inside]]
+        bary = np.einsum('nij,nj->ni', transform[:, :2], points[inside] - transform[:, 2])
+        bary = np.column_stack([bary, 1 - bary.sum(axis=1)])
+
+        rows = np.repeat(np.flatnonzero(inside), 3)
+        cols = tri.simplices[simplex[inside]].ravel()
+        weights = sparse.csr_matrix((bary.ravel(), (rows, cols)), shape=(len(points), lat_in.size))
+        return cls(weights, ~inside.reshape(lat_out.shape))
+
+
+    def regrid_array(self, 
+                     values: np.ndarray,
+                     n_workers: int = 1,
+                     chunk_size: int = 24,
+                     ) -> np.ndarray:
+        """ 
+        Regrid values (..., y, x) on the source grid to (..., y, x) on the target grid.
+        The leading dimensions are flattened and regridded in chunks of chunk_size, in parallel if 
+        n_workers > 1, each written into the preallocated output (see regrid_time_parallel).
+        """
+        flat = values.reshape(-1, self.weights.shape[1])
+        out = np.empty((flat.shape[0], self.weights.shape[0]), 
+                       dtype=np.result_type(self.weights.dtype, values.dtype))
+        outside = self.outside.ravel()
+
+        def regrid_chunk(sl):
+            out[sl] = (self.weights @ flat[sl].T).T
+            out[sl, outside] = np.nan
+
+        regrid_time_parallel(regrid_chunk, flat.shape[0], n_workers=n_workers, chunk_size=chunk_size)
+        return out.reshape(values.shape[:-2] + self.outside.shape)
+
+
+    def to_file(self, filepath: str) -> None:
+        w = self.weights
+        with open(filepath, 'wb') as f:
+            np.savez(f, data=w.data, indices=w.indices, indptr=w.indptr, shape=w.shape, outside=self.outside)
+
+
+    @classmethod
+    def from_file(cls, filepath: str) -> 'BarycentricRegridder':
+        f = np.load(filepath)
+        weights = sparse.csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+        return cls(weights, f['outside'])
+
+
+class RegridderCache:
+    """
+    Two tier cache of regridders keyed by grid_digest, xESMF regridders or BarycentricRegridder 
+    for method='barycentric'.
+    Regridders are kept in memory (LRU, at most max_regridders), and their weights are saved to
+    {weights_dir}/{method}_{digest}.nc (.npz for barycentric) so other processes can skip computing them.
+    Weight files are written atomically, concurrent jobs never read a partially written file.
+    """
+
+    def __init__(self,
+                 weights_dir: str = None,
+                 max_regridders: int = 8,
+                 ) -> None:
+        self.weights_dir = weights_dir
+        self.max_regridders = max_regridders
+        self._regridders = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self,
+            ds_in,
+            ds_out,
+            method: str = 'bilinear',
+            ):
+        """
+        Regridder from the grid of ds_in to the grid of ds_out
+        Args:
+            ds_in, ds_out (xr.Dataset or xr.DataArray): source and target grids, without a time dimension
+            method (str): xESMF regridding method e.g. 'bilinear', or 'barycentric'
+        """
+        key = grid_digest(ds_in, ds_out, method)
+        with self._lock:
+            if key in self._regridders:
+                self._regridders.move_to_end(key)
+                return self._regridders[key]
+
+        weights_dir = self.weights_dir if self.weights_dir is not None else get_weights_dir()
+        barycentric = method == 'barycentric'
+        if not barycentric and xe is None:
+            raise ImportError(f"xesmf is required for method={method}, or use method='barycentric'")
+        extension = 'npz' if barycentric else 'nc'
+        filepath = None if weights_dir is None else os.path.join(weights_dir, f'{method}_{key}.{extension}')
+
+        if filepath is not None and os.path.exists(filepath):
+            if barycentric:
+                regridder = BarycentricRegridder.from_file(filepath)
+            else:
+                regridder = xe.Regridder(ds_in, ds_out, method, reuse_weights=True, filename=filepath)
+        else:
+            if barycentric:
+                regridder = BarycentricRegridder.from_grids(ds_in, ds_out)
+            else:
+                regridder = xe.Regridder(ds_in, ds_out, method, reuse_weights=False)
+            if filepath is not None:
+                os.makedirs(weights_dir, exist_ok=True)
+                tmp_filepath = f'{filepath}.{os.getpid()}.tmp'
+                if barycentric:
+                    regridder.to_file(tmp_filepath)
+                else:
+                    regridder.to_netcdf(tmp_filepath)
+                os.replace(tmp_filepath, filepath)
+
+        with self._lock:
+            self._regridders[key] = regridder
+            while len(self._regridders) > self.max_regridders:
+                self._regridders.popitem(last=False)
+        return regridder
+
+
+    def clear(self) -> None:
+        """ Drop the in-memory regridders, weight files are kept """
+        with self._lock:
+            self._regridders.clear()
+
+
+    def __len__(self) -> int:
+        return len(self._regridders)
+
+
+# shared by every process class in this process
+REGRIDDER_CACHE = RegridderCache()
+
+
+def get_regridder(ds_in, ds_out, method: str = 'bilinear'):
+    """ Cached regridder from the grid of ds_in to the grid of ds_out, see RegridderCache """
+    return REGRIDDER_CACHE.get(ds_in, ds_out, method)
@@ -0,0 +1,220 @@
+import os
+import shutil
+import uuid
+from typing import List
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from nzdownscale.dataprocess.config_local import DATA_PATHS
+
+
+def get_store_root() -> str:
+    """ Root directory for station stores, DATA_PATHS['stations']['store'] or a subfolder of DATA_PATHS['cache'] """
+    if 'store' in DATA_PATHS['stations'].keys():
+        return DATA_PATHS['stations']['store']
+    if 'cache' in DATA_PATHS.keys():
+        return f'{DATA_PATHS["cache"]}/station_store'
+    raise ValueError("Please set 'store' in DATA_PATHS['stations'] or a 'cache' path in DATA_PATHS dict e.g. 'cache':'data/.datacache'")
+
+
+class StationStore:
+    """
+    Columnar store of all station observations in one station subdirectory (e.g. ScreenObs).
+    Observations are saved as Parquet, partitioned by year and keyed by station_id:
+
+        {root}/{subdir}/stations.parquet            station_id, station_name, latitude, longitude, 
+                                                    start_time, end_time, n_obs
+        {root}/{subdir}/obs/year=YYYY/*.parquet     time, station_id, <observation columns>
+        {root}/{subdir}/obs_schema.parquet          schema of all observation columns (no rows)
+
+    The stations table is written last, so a store only exists once an ingest has completed.
+    Appends add new part files to the year partitions and never rewrite existing ones.
+    Part files only hold the columns known when they were written, columns added later 
+    (e.g. a variable only in some station files) read as null from the older files.
+    """
+
+    def __init__(self,
+                 subdir: str,
+                 root: str = None,
+                 ) -> None:
+        if root is None:
+            root = get_store_root()
+        self.subdir = subdir
+        self.path = f'{root}/{subdir}'
+        self.obs_path = f'{self.path}/obs'
+        self.stations_path = f'{self.path}/stations.parquet'
+        self.schema_path = f'{self.path}/obs_schema.parquet'
+
+
+    def exists(self) -> bool:
+        return os.path.exists(self.stations_path)
+
+
+    def clear(self) -> None:
+        """ Remove everything in the store """
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+    def write_obs(self,
+                  df: pd.DataFrame,
+                  tag: str,
+                  ) -> None:
+        """
+        Write observations into the year partitions
+        Args:
+            df (pd.DataFrame): columns time, station_id and observation columns
+            tag (str): unique name for this batch of files
+        """
+        df = df.sort_values(['station_id', 'time'])
+        schema = self.schema()
+        fields = [] if schema is None else list(schema)
+        names = [field.name for field in fields]
+        # columns already in the store keep their types, new columns are added to the schema
+        new_names = [name for name in df.columns if name not in names]
+        fields += list(pa.Table.from_pandas(df[new_names], preserve_index=False).schema)
+        schema = pa.schema(fields)
+        table = pa.Table.from_pandas(df.reindex(columns=schema.names), schema=schema, preserve_index=False)
+        table = table.append_column('year', pa.array(df['time'].dt.year.values, type=pa.int32()))
+        if len(new_names) > 0:
+            self._write_schema(schema)
+        pq.write_to_dataset(table,
+                            self.obs_path,
+                            partition_cols=['year'],
+                            basename_template=f'part-{tag}-{{i}}.parquet',
+                            existing_data_behavior='overwrite_or_ignore',
+                            )
+
+
+    def schema(self) -> pa.Schema:
+        """ Schema of the observations (time, station_id and observation columns), None if nothing was written """
+        if os.path.exists(self.schema_path):
+            return pq.read_schema(self.schema_path)
+        if not os.path.exists(self.obs_path):
+            return None
+        # store written before the schema was kept
+        dataset = ds.dataset(self.obs_path, format='parquet', partitioning='hive')
+        schema = pa.unify_schemas([fragment.physical_schema for fragment in dataset.get_fragments()])
+        return pa.schema([field for field in schema if field.name != 'year'])
+
+
+    def _write_schema(self, 
+                      schema: pa.Schema,
+                      ) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = f'{self.schema_path}.tmp'
+        pq.write_table(schema.empty_table(), tmp_path)
+        os.replace(tmp_path, self.schema_path)
+
+
+    def append_obs(self,
+                   df: pd.DataFrame,
+                   ) -> None:
+        """ Add observations to the store as new part files, existing files are left untouched """
+        tag = f'append-{pd.Timestamp.now():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}'
+        self.write_obs(df, tag=tag)
+
+
+    def write_stations(self,
+                       df: pd.DataFrame,
+                       ) -> None:
+        """ Write station table (station_id, station_name, latitude, longitude, start_time, end_time, n_obs) """
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = f'{self.stations_path}.tmp'
+        df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, self.stations_path)
+
+
+    def update_stations(self,
+                        df_new: pd.DataFrame,
+                        ) -> pd.DataFrame:
+        """
+        Merge appended stations into the station table
+        Args:
+            df_new (pd.DataFrame): indexed by station_id, columns station_name, latitude, longitude 
+                (new stations only) and start_time, end_time, n_obs of the appended observations
+        Returns:
+            df: updated station table indexed by station_id
+        """
+        df = self.read_stations()
+        df = df.reindex(df.index.union(df_new.index))
+        new = df_new.index.difference(self.read_stations().index)
+        for col in ['station_name', 'latitude', 'longitude']:
+            df.loc[new, col] = df_new.loc[new, col]
+        df.loc[df_new.index, 'start_time'] = pd.concat([df.loc[df_new.index, 'start_time'], 
+                                                        df_new['start_time']], axis=1).min(axis=1)
+        df.loc[df_new.index, 'end_time'] = pd.concat([df.loc[df_new.index, 'end_time'], 
+                                                      df_new['end_time']], axis=1).max(axis=1)
+        df.loc[df_new.index, 'n_obs'] = df.loc[df_new.index, 'n_obs'].fillna(0) + df_new['n_obs']
+        df['n_obs'] = df['n_obs'].astype(int)
+        self.write_stations(df.reset_index())
+        return df
+
+
+    def columns(self) -> List[str]:
+        """ Observation columns in the store """
+        return [name for name in self.schema().names if name not in ['time', 'station_id']]
+
+
+    def read_stations(self) -> pd.DataFrame:
+        """ Station table indexed by station_id """
+        df = pd.read_parquet(self.stations_path).set_index('station_id')
+        if not {'start_time', 'end_time', 'n_obs'}.issubset(df.columns):
+            df = self._backfill_time_ranges(df)
+        return df
+
+
+    def _backfill_time_ranges(self,
+                              df: pd.DataFrame,
+                              ) -> pd.DataFrame:
+        """ Add start_time, end_time and n_obs to the station table of a store built before they were kept """
+        print(f'Adding time ranges to the {self.subdir} station table...')
+        df_time = self.read(columns=[]).groupby('station_id')['time'].agg(start_time='min', end_time='max', n_obs='count')
+        df = df.drop(columns=['start_time', 'end_time', 'n_obs'], errors='ignore').join(df_time)
+        df['n_obs'] = df['n_obs'].fillna(0).astype(int)
+        self.write_stations(df.reset_index())
+        return df
+
+
+    def read(self,
+             columns: List[str] = None,
+             station_ids: List[str] = None,
+             years: List[int] = None,
+             start=None,
+             end=None,
+             ) -> pd.DataFrame:
+        """
+        Read observations, filters are pushed down to the Parquet reader
+        Args:
+            columns (list): observation columns, all if None
+            station_ids (list): only these stations, all if None
+            years (list): only these years, all if None
+            start, end: only times within [start, end]
+        Returns:
+            df: columns time, station_id and observation columns
+        """
+        filters = []
+        if years is not None:
+            filters.append(('year', 'in', [int(year) for year in years]))
+        if station_ids is not None:
+            station_ids = [str(s) for s in station_ids]
+            if len(station_ids) == 0:
+                return pd.DataFrame(columns=['time', 'station_id'] + list(columns or []))
+            filters.append(('station_id', 'in', station_ids))
+        if start is not None:
+            filters.append(('time', '>=', pd.Timestamp(start)))
+        if end is not None:
+            filters.append(('time', '<=', pd.Timestamp(end)))
+
+        if columns is not None:
+            columns = ['time', 'station_id'] + list(columns)
+
+        # the full schema, so files written before a column was added read it as null
+        partitioning = ds.partitioning(pa.schema([('year', pa.int32())]), flavor='hive')
+        dataset = ds.dataset(self.obs_path, format='parquet', partitioning=partitioning,
+                             schema=self.schema().append(pa.field('year', pa.int32())))
+        table = dataset.to_table(columns=columns, 
+                                 filter=pq.filters_to_expression(filters) if len(filters) > 0 else None)
+        return table.to_pandas().drop(columns='year', errors='ignore')
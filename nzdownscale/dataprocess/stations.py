@@ -1,21 +1,54 @@
 import os
 from typing import Literal, List
+from functools import partial
 
 import xarray as xr
 import pandas as pd
-from tqdm import tqdm
 import numpy as np
+from sklearn.neighbors import BallTree
 
-from nzdownscale.dataprocess.utils import DataProcess, PlotData
-from nzdownscale.dataprocess.config import VARIABLE_OPTIONS, VAR_STATIONS, STATION_LATLON
+from nzdownscale.dataprocess.utils import DataProcess, PlotData, FileIndex, load_parallel
+from nzdownscale.dataprocess.config import VARIABLE_OPTIONS, VAR_STATIONS, STATION_LATLON, PLOT_EXTENT
 from nzdownscale.dataprocess.config_local import DATA_PATHS
+from nzdownscale.dataprocess.station_store import StationStore
 
+# records of the station metadata index, see get_metadata_index
+METADATA_COLUMNS = ['station_id', 'station_name', 'station_no', 'lat', 'lon', 'elevation', 
+                    'start_time', 'end_time', 'n_obs']
 
 
 class ProcessStations(DataProcess):
 
-    def __init__(self) -> None:
+    def __init__(self, 
+                 use_store: bool = True,
+                 n_workers: int = 1,
+                 use_processes: bool = True,
+                 compact: bool = False,
+                 ) -> None:
+        """
+        Args:
+            use_store (bool): read from the station store (see build_station_store) when it exists
+            n_workers (int): number of workers used to read station files (1 reads serially)
+            use_processes (bool): read station files in a process pool. Set to False for a thread pool, 
+                only safe if netCDF4/HDF5 were built thread-safe
+            compact (bool): compact dtypes for loaded station data: float32 observations, categorical 
+                station_name and station_id. Stations are carried as integer codes into a station table 
+                until after concatenation, so coordinates and names aren't repeated on every row
+        """
         super().__init__()
+        self.use_store = use_store
+        self.compact = compact
+        self.n_workers = n_workers
+        self.use_processes = use_processes
+        self.load_failures = {}
+        self._metadata_indexes = {}
+
+
+    def __getstate__(self):
+        """ Leave the metadata indexes behind when sent to worker processes """
+        state = self.__dict__.copy()
+        state['_metadata_indexes'] = {}
+        return state
 
 
     def get_parent_path(self,
@@ -35,13 +68,306 @@ class ProcessStations(DataProcess):
             var (str): variable
             return_uv (bool): return both wind components u and v
         """
-        if 'wind' in var:
-            self.get_wind_components(ds)
+        if self.is_wind_component(var):
+            # only the requested components, from speed and direction read once
+            components = ['u', 'v'] if return_uv else [VAR_STATIONS[var]['var_name']]
+            ds = self.get_wind_components(ds[['speed', 'direction']], components=components)
             if return_uv:
                 return ds[['u', 'v']]
         return ds[VAR_STATIONS[var]['var_name']]
 
 
+    def is_wind_component(self,
+                          var: Literal[tuple(VARIABLE_OPTIONS)],
+                          ) -> bool:
+        """ True for the u and v wind components, which are derived from station speed and direction """
+        return VAR_STATIONS[var]['var_name'] in ['u', 'v']
+
+
+    def get_station_id(self,
+                       filepath: str,
+                       ) -> str:
+        """ Station id from station filepath e.g. '.../ScreenObs/1234.nc' -> '1234' """
+        return filepath.split('.nc')[0].split('/')[-1]
+
+
+    def get_store(self,
+                  var: Literal[tuple(VARIABLE_OPTIONS)],
+                  ) -> StationStore:
+        """ Station store for variable var (shared by all variables in the same subdir) """
+        return StationStore(VAR_STATIONS[var]['subdir'])
+
+
+    def _store_available(self, var) -> bool:
+        if not self.use_store:
+            return False
+        try:
+            store = self.get_store(var)
+        except ValueError:
+            # no store root configured, read the station files
+            return False
+        return store.exists()
+
+
+    def _load_files(self, load_fn, paths, desc='Loading stations') -> list:
+        """ 
+        Apply load_fn to each station file in the worker pool, results are in the order of paths.
+        Files that fail are skipped, and recorded in self.load_failures (filepath -> error).
+        Raises ValueError if every file fails.
+        """
+        paths = list(paths)
+        results, failures = load_parallel(load_fn, paths, 
+                                          n_workers=self.n_workers, 
+                                          use_processes=self.use_processes,
+                                          desc=desc)
+        self.load_failures.update(failures)
+        if len(paths) > 0 and len(failures) == len(paths):
+            failed = '\n'.join(f'{path}: {error}' for path, error in failures.items())
+            raise ValueError(f'All {len(paths)} station files failed to load:\n{failed}')
+        if len(failures) > 0:
+            print(f'{len(failures)} station files failed to load, see ProcessStations.load_failures')
+        return results
+
+
+    def build_station_store(self,
+                            var: Literal[tuple(VARIABLE_OPTIONS)],
+                            batch_size: int = 200,
+                            ) -> StationStore:
+        """
+        One-off ingest: packs every station file for variable var into a single Parquet store,
+        partitioned by year and keyed by station id. Once built, station loads read from the
+        store instead of opening each netCDF file.
+        Args:
+            var (str): variable
+            batch_size (int): number of station files held in memory before writing
+        """
+        store = self.get_store(var)
+        store.clear()
+        paths = sorted(self.get_path_all_stations(var))
+
+        station_list = []
+        for i in range(0, len(paths), batch_size):
+            records = self._load_files(self._station_file_to_records, paths[i:i + batch_size], 
+                                       desc=f'Ingesting {store.subdir} stations')
+            store.write_obs(pd.concat([df_obs for df_obs, _ in records]), tag=str(i // batch_size).zfill(5))
+            station_list.extend([station for _, station in records])
+        store.write_stations(pd.DataFrame(station_list))
+        return store
+
+
+    def _station_file_to_records(self,
+                                 filepath: str,
+                                 ) -> tuple:
+        """ Observations (time, station_id, data variables) and station info from a station file """
+        station_id = self.get_station_id(filepath)
+        with self.load_station(filepath) as ds:
+            data_vars = [v for v in ds.data_vars 
+                         if ds[v].dims == ('time',) and np.issubdtype(ds[v].dtype, np.number)]
+            df_obs = self._add_derived_columns(ds[data_vars].to_dataframe()[data_vars].reset_index())
+            lon, lat = self.get_lon_lat(ds)
+            station = {
+                'station_id': station_id,
+                'station_name': ds.attrs['site name'],
+                'latitude': lat,
+                'longitude': lon,
+                'start_time': df_obs['time'].min(),
+                'end_time': df_obs['time'].max(),
+                'n_obs': len(df_obs),
+                }
+        df_obs['station_id'] = station_id
+        return df_obs, station
+
+
+    def _add_derived_columns(self,
+                             df_obs: pd.DataFrame,
+                             ) -> pd.DataFrame:
+        """ Derived variables materialised in the station store: u and v wind components from speed and direction """
+        if {'speed', 'direction'}.issubset(df_obs.columns) and 'u' not in df_obs.columns:
+            df_obs = self.get_wind_components(df_obs)
+        return df_obs
+
+
+    def _store_columns(self,
+                       var: Literal[tuple(VARIABLE_OPTIONS)],
+                       store: StationStore,
+                       return_uv: bool = False,
+                       ) -> List[str]:
+        """ Store columns needed to load variable var """
+        if not self.is_wind_component(var):
+            return [VAR_STATIONS[var]['var_name']]
+        columns = ['u', 'v'] if return_uv else [VAR_STATIONS[var]['var_name']]
+        if not set(columns).issubset(store.columns()):
+            # store built before the wind components were materialised
+            columns = ['speed', 'direction']
+        return columns
+
+
+    def append_stations(self,
+                        var: Literal[tuple(VARIABLE_OPTIONS)],
+                        filepaths: List[str] = None,
+                        df: pd.DataFrame = None,
+                        ) -> int:
+        """
+        Incremental ingest into an existing station store (see build_station_store), for operational updates.
+        Only observations later than the last stored time of each station are added, as new part files, 
+        so historical partitions are never rewritten. Earlier observations (e.g. corrections) are skipped 
+        and counted, rebuild the store to ingest them. Loads see the new data on their next read, 
+        stations are selected from the store's station table (see get_store_metadata).
+        Args:
+            var (str): variable
+            filepaths (list): new or updated station files, e.g. files that were extended with the latest hour
+            df (pd.DataFrame): observation records with columns time, station_id and observation columns, 
+                plus station_name, latitude and longitude for stations not yet in the store
+        Returns:
+            int: number of observations added
+        """
+        store = self.get_store(var)
+        if not store.exists():
+            raise ValueError(f'No station store for {var}, run build_station_store first')
+
+        station_cols = ['station_name', 'latitude', 'longitude']
+        obs_list, station_list = [], []
+        if filepaths is not None:
+            records = self._load_files(self._station_file_to_records, filepaths, 
+                                       desc=f'Appending {store.subdir} stations')
+            obs_list.extend([df_obs for df_obs, _ in records])
+            station_list.extend([station for _, station in records])
+        if df is not None:
+            df = df.reset_index() if 'time' not in df.columns else df.copy()
+            df['station_id'] = df['station_id'].astype(str)
+            if set(station_cols).issubset(df.columns):
+                station_list.extend(df.groupby('station_id')[station_cols].first().reset_index().to_dict('records'))
+            obs_list.append(self._add_derived_columns(df.drop(columns=station_cols, errors='ignore')))
+        if len(obs_list) == 0:
+            return 0
+
+        df_stations = store.read_stations()
+        df_obs = pd.concat(obs_list).drop_duplicates(['station_id', 'time'])
+        last_time = df_obs['station_id'].map(df_stations['end_time']).fillna(pd.Timestamp.min)
+        is_new = df_obs['time'] > last_time
+        if not is_new.all():
+            n_skipped = (~is_new).sum()
+            n_stations = df_obs.loc[~is_new, 'station_id'].nunique()
+            print(f'Skipped {n_skipped} observations of {n_stations} stations at or before their last stored time')
+        df_obs = df_obs[is_new]
+        if len(df_obs) == 0:
+            print('No new station observations')
+            return 0
+
+        df_new = df_obs.groupby('station_id')['time'].agg(start_time='min', end_time='max', n_obs='count')
+        df_info = pd.DataFrame(station_list, columns=['station_id'] + station_cols).drop_duplicates('station_id')
+        df_new = df_new.join(df_info.set_index('station_id'))
+        new_ids = df_new.index.difference(df_stations.index)
+        missing = new_ids[df_new.loc[new_ids, station_cols].isna().any(axis=1).values]
+        if len(missing) > 0:
+            raise ValueError(f'No station_name, latitude, longitude given for new stations {list(missing)}')
+
+        store.append_obs(df_obs)
+        store.update_stations(df_new)
+        print(f'Appended {len(df_obs)} observations for {len(df_new)} stations')
+        return len(df_obs)
+
+
+    def _store_to_station_df(self,
+                             df_obs: pd.DataFrame,
+                             var: str,
+                             df_stations: pd.DataFrame,
+                             return_uv: bool = False,
+                             ) -> pd.DataFrame:
+        """ Convert store records to the load_station_df layout for each station, concatenated """
+        if self.is_wind_component(var) and 'speed' in df_obs.columns:
+            df_obs = self.get_wind_components(df_obs)
+        if self.is_wind_component(var) and return_uv:
+            columns = ['u', 'v']
+        else:
+            columns = [VAR_STATIONS[var]['var_name']]
+
+        if self.compact:
+            station_table = df_stations.reset_index()
+            df = df_obs[['time'] + columns].astype({col: np.float32 for col in columns}).set_index('time')
+            df['station_code'] = pd.Index(station_table['station_id']).get_indexer(df_obs['station_id']).astype(np.int32)
+            df = self._expand_station_codes(df, station_table)
+            return df[['station_id'] + columns + ['longitude', 'latitude', 'station_name']]
+
+        df = df_obs[['time', 'station_id'] + columns].set_index('time')
+        df['longitude'] = df['station_id'].map(df_stations['longitude'])
+        df['latitude'] = df['station_id'].map(df_stations['latitude'])
+        df['station_name'] = df['station_id'].map(df_stations['station_name'])
+        return df
+
+
+    def get_station_table(self,
+                          var: Literal[tuple(VARIABLE_OPTIONS)],
+                          filepaths: List[str],
+                          ) -> pd.DataFrame:
+        """ Lookup table of station_id, station_name, latitude, longitude, row i is station code i of filepaths[i] """
+        df_md = self.get_metadata_index(var).reindex(filepaths)
+        return pd.DataFrame({
+            'station_id': [self.get_station_id(path) for path in filepaths],
+            'station_name': df_md['station_name'].values,
+            'latitude': df_md['lat'].values,
+            'longitude': df_md['lon'].values,
+            })
+
+
+    def _expand_station_codes(self,
+                              df: pd.DataFrame,
+                              station_table: pd.DataFrame,
+                              ) -> pd.DataFrame:
+        """ Replace the integer station_code column by longitude, latitude and categorical station_name, station_id """
+        codes = df.pop('station_code').values
+        df['longitude'] = station_table['longitude'].values[codes]
+        df['latitude'] = station_table['latitude'].values[codes]
+        for col in ['station_name', 'station_id']:
+            cat = pd.Categorical(station_table[col])
+            df[col] = pd.Categorical.from_codes(cat.codes[codes], categories=cat.categories)
+        return df
+
+
+    def aggregate_stations(self,
+                           df: pd.DataFrame,
+                           var: str,
+                           freq: str = 'D',
+                           function: Literal['mean', 'sum'] = None,
+                           return_counts: bool = False,
+                           min_obs: int = None,
+                           ) -> pd.DataFrame:
+        """
+        Aggregate the observations of all stations in df to frequency freq, 
+        in one grouped reduction keyed by station and period. Periods without observations are left out.
+        Args:
+            df (pd.DataFrame): indexed by time, with station_id, observation, longitude, latitude 
+                and station_name columns (e.g. from load_station_dfs)
+            var (str): variable
+            freq (str): pandas frequency of the periods, e.g. 'D', '6h', 'MS'
+            function (str): 'mean' or 'sum'. If None, sum for precipitation and mean otherwise
+            return_counts (bool): add an n_obs column, the number of observations in each period
+            min_obs (int): drop periods with fewer observations, e.g. 24 to keep only complete days of hourly data
+        Returns:
+            df: indexed by the start of each period, with the columns of df
+        """
+        if function is None:
+            function = 'sum' if var == 'precipitation' else 'mean'
+        station_cols = ['longitude', 'latitude', 'station_name']
+        value_cols = [col for col in df.columns if col not in station_cols + ['station_id']]
+
+        grouped = df.groupby(['station_id', pd.Grouper(freq=freq)], observed=True, sort=False)
+        df_agg = getattr(grouped[value_cols], function)()
+        n_obs = grouped[value_cols[0]].count()
+        if min_obs is not None:
+            df_agg = df_agg[n_obs >= min_obs]
+            n_obs = n_obs[n_obs >= min_obs]
+
+        df_agg = df_agg.reset_index(level='station_id')
+        df_first = df.groupby('station_id', observed=True, sort=False)[station_cols].first()
+        for col in station_cols:
+            df_agg[col] = df_agg['station_id'].map(df_first[col])
+        df_agg = df_agg[list(df.columns)]
+        if return_counts:
+            df_agg['n_obs'] = n_obs.values
+        return df_agg
+
+
     def get_path_all_stations(self,
                               var: Literal[tuple(VARIABLE_OPTIONS)],
                               ) -> List[str]:
@@ -62,62 +388,201 @@ class ProcessStations(DataProcess):
                         daily: bool = False,
                         fill_missing: bool = True,
                         return_uv: bool = False,
+                        start=None,
+                        end=None,
+                        min_obs: int = None,
+                        return_counts: bool = False,
                         ) -> pd.DataFrame:
-        ds = self.load_station(filepath)
-        da = self.ds_to_da(ds, var, return_uv)
-        df_station = da.to_dataframe()
+        if self._store_available(var):
+            df_station = self.load_station_dfs([filepath], var, daily=daily, return_uv=return_uv, start=start, end=end,
+                                               min_obs=min_obs, return_counts=return_counts)
+            return df_station.drop(columns='station_id')
+
+        with self.load_station(filepath) as ds:
+            if start is not None or end is not None:
+                ds = ds.sel(time=slice(start, end))
+            da = self.ds_to_da(ds, var, return_uv)
+            df_station = da.to_dataframe()
+            lon, lat = self.get_lon_lat(ds)
+            df_station['longitude'] = lon
+            df_station['latitude'] = lat
+            df_station['station_name'] = ds.attrs['site name']
         if daily: 
-            df_station = df_station.reset_index().resample('D', on='time').mean()[[VAR_STATIONS[var]['var_name']]]
-        lon, lat = self.get_lon_lat(ds)
-        df_station['longitude'] = lon
-        df_station['latitude'] = lat
-        df_station['station_name'] = ds.attrs['site name']
+            df_station['station_id'] = self.get_station_id(filepath)
+            df_station = self.aggregate_stations(df_station, var, function='mean', 
+                                                 min_obs=min_obs, return_counts=return_counts).drop(columns='station_id')
 
         return df_station
 
 
+    def load_station_dfs(self,
+                         filepaths: List[str],
+                         var: str,
+                         daily: bool = False,
+                         return_uv: bool = False,
+                         years: List[int] = None,
+                         start=None,
+                         end=None,
+                         min_obs: int = None,
+                         return_counts: bool = False,
+                         ) -> pd.DataFrame:
+        """
+        Load several stations and concatenate them, equivalent to pd.concat of load_station_df
+        over filepaths. Reads the station store in a single pass when it exists.
+        Args:
+            filepaths (list): station filepaths
+            var (str): variable
+            daily (bool): resample to daily (mean), all stations are aggregated together after loading
+            return_uv (bool): return both wind components u and v
+            years (list): only read these years from the store (all years if None)
+            start, end: only times within [start, end]
+            min_obs (int): if daily, drop days with fewer observations, e.g. 24 for complete days of hourly data
+            return_counts (bool): if daily, add an n_obs column, the number of observations of each day
+        Returns:
+            df: indexed by time, with variable, longitude, latitude, station_name and station_id columns
+        """
+        if not self._store_available(var):
+            if self.compact:
+                station_table = self.get_station_table(var, filepaths)
+                station_codes = {path: i for i, path in enumerate(filepaths)}
+            else:
+                station_codes = None
+            load_fn = partial(self._load_station_df_with_id, var=var, return_uv=return_uv,
+                              station_codes=station_codes, start=start, end=end)
+            df = pd.concat(self._load_files(load_fn, filepaths))
+            if self.compact:
+                df = self._expand_station_codes(df, station_table)
+            if daily:
+                df = self.aggregate_stations(df, var, function='mean', min_obs=min_obs, return_counts=return_counts)
+            return df
+
+        store = self.get_store(var)
+        station_ids = [self.get_station_id(path) for path in filepaths]
+        return self._read_store_df(store, var, station_ids, 
+                                   columns=self._store_columns(var, store, return_uv), 
+                                   df_stations=store.read_stations(),
+                                   daily=daily, return_uv=return_uv, years=years, start=start, end=end,
+                                   min_obs=min_obs, return_counts=return_counts)
+
+
+    def _read_store_df(self, store, var, station_ids, columns, df_stations, 
+                       daily=False, return_uv=False, years=None, start=None, end=None, 
+                       min_obs=None, return_counts=False):
+        """ load_station_dfs from the store, with the columns and stations table already read """
+        df_obs = store.read(columns=columns, station_ids=station_ids, years=years, start=start, end=end)
+        df = self._store_to_station_df(df_obs, var, df_stations, return_uv=return_uv)
+        if daily:
+            df = self.aggregate_stations(df, var, function='mean', min_obs=min_obs, return_counts=return_counts)
+        return df
+
+
+    def _load_station_df_with_id(self, filepath, var, daily=False, return_uv=False, station_codes=None, 
+                                 start=None, end=None):
+        df_station = self.load_station_df(filepath, var, daily=daily, return_uv=return_uv, start=start, end=end)
+        if station_codes is not None:
+            # compact: observations as float32 and an integer station code, coordinates are added after concatenation
+            df_station = df_station.drop(columns=['longitude', 'latitude', 'station_name']).astype(np.float32)
+            df_station['station_code'] = np.int32(station_codes[filepath])
+        else:
+            df_station['station_id'] = self.get_station_id(filepath)
+        return df_station
+
+
     def get_lon_lat(self,
                     ds: xr.Dataset,
                     ) -> tuple:
         return float(ds.longitude), float(ds.latitude)
     
 
+    def get_metadata_index(self,
+                           var: Literal[tuple(VARIABLE_OPTIONS)],
+                           use_cache: bool = True,
+                           ) -> pd.DataFrame:
+        """
+        Station metadata for all station files of variable var, indexed by filepath:
+        station_id, station_name, station_no, lat, lon, elevation, start_time, end_time, n_obs.
+        Answered from a metadata index that only re-reads station files whose mtime or size changed.
+        The index is kept on disk in DATA_PATHS['cache'] if set (and use_cache=True), otherwise in memory.
+        Unreadable station files are left out.
+        """
+        subdir = VAR_STATIONS[var]['subdir']
+        if use_cache and 'cache' in DATA_PATHS.keys():
+            filepath = f'{DATA_PATHS["cache"]}/station_data/metadata_index_{subdir}.pkl'
+        else:
+            filepath = None
+        if (subdir, filepath) not in self._metadata_indexes:
+            self._metadata_indexes[(subdir, filepath)] = FileIndex(filepath, columns=METADATA_COLUMNS)
+        return self._metadata_indexes[(subdir, filepath)].refresh(self.get_path_all_stations(var), 
+                                                      self._read_station_metadata,
+                                                      desc=f'Indexing {subdir} stations',
+                                                      n_workers=self.n_workers,
+                                                      use_processes=self.use_processes)
+
+
+    def _read_station_metadata(self,
+                               filepath: str,
+                               ) -> dict:
+        with self.load_station(filepath) as ds:
+            lon, lat = self.get_lon_lat(ds)
+            if 'station_height' in ds.variables:
+                elevation = float(ds['station_height'].values)
+            else:
+                elevation = np.nan
+            return {
+                'station_id': self.get_station_id(filepath),
+                'station_name': ds.attrs['site name'],
+                'station_no': ds.attrs['agent_number'],
+                'lat': lat,
+                'lon': lon,
+                'elevation': elevation,
+                'start_time': pd.Timestamp(ds['time'][0].values),
+                'end_time': pd.Timestamp(ds['time'][-1].values),
+                'n_obs': len(ds['time']),
+                }
+
+
     def get_metadata_df(self,
                         var: Literal[tuple(VARIABLE_OPTIONS)],
+                        use_cache: bool = True,
                         ) -> pd.DataFrame: 
         """ get station metadata in dataframe format """
-        dict_md = self.get_metadata_dict(var=var)
-        df = self.dict_to_df(dict_md)
-        df['station_id'] = df.index
-        df['station_id'] = df['station_id'].apply(lambda row: row.split('.nc')[0].split('/')[-1])
+        if self._store_available(var):
+            df = self.get_store_metadata(var)
+            # station_no and elevation are only in the station files
+            df_files = self.get_metadata_index(var, use_cache=use_cache).drop_duplicates('station_id').set_index('station_id')
+            for col in ['station_no', 'elevation']:
+                df[col] = df['station_id'].map(df_files[col])
+            df = df[METADATA_COLUMNS]
+        else:
+            df = self.get_metadata_index(var, use_cache=use_cache).copy()
+        df['start_year'] = pd.to_datetime(df['start_time']).dt.year
+        df['end_year'] = pd.to_datetime(df['end_time']).dt.year
+        df['duration_years'] = df['end_year'] - df['start_year']
         return df
         
 
+    def get_store_metadata(self,
+                           var: Literal[tuple(VARIABLE_OPTIONS)],
+                           ) -> pd.DataFrame:
+        """
+        Station metadata from the station table of the store, including stations added by append_stations
+        without a station file. Indexed by station filepath (the path the station file has or would have), 
+        with station_id, station_name, lat, lon, start_time, end_time and n_obs columns.
+        """
+        df = self.get_store(var).read_stations().reset_index()
+        df = df.rename(columns={'latitude': 'lat', 'longitude': 'lon'})
+        df.index = [f'{self.get_parent_path(var)}/{station_id}.nc' for station_id in df['station_id']]
+        return df[['station_id', 'station_name', 'lat', 'lon', 'start_time', 'end_time', 'n_obs']]
+
+
     def get_metadata_dict(self, 
                           var: Literal[tuple(VARIABLE_OPTIONS)],
+                          use_cache: bool = True,
                           ) -> dict:
         """ get dictionary of min max years and coords"""
-
-        station_paths = self.get_path_all_stations(var)        
-        dict_md = {}
-        for f in tqdm(station_paths, desc='Loading stations'):
-            try:
-                ds = self.load_station(f)
-                lon, lat = self.get_lon_lat(ds)
-                start_year, end_year = self.get_start_and_end_years(ds)
-                duration = end_year - start_year
-
-                dict_md[f] = {
-                    'start_year': int(start_year), 
-                    'end_year': int(end_year), 
-                    'duration_years': int(duration),
-                    'lon': lon, 
-                    'lat':lat,
-                    }
-            except:
-                pass
-
-        return dict_md
+        df = self.get_metadata_df(var, use_cache=use_cache)
+        df = df[['start_year', 'end_year', 'duration_years', 'lon', 'lat']]
+        return df.to_dict(orient='index')
     
 
     def get_start_and_end_years(self, ds: xr.Dataset):
@@ -128,17 +593,7 @@ class ProcessStations(DataProcess):
     def get_coord_df(self, 
                      var: Literal[tuple(VARIABLE_OPTIONS)],
                      ) -> pd.DataFrame:
-        station_paths = self.get_path_all_stations(var)
-        dict_coord = {}
-        for f in tqdm(station_paths):
-            ds = self.load_station(f)
-            lon, lat = self.get_lon_lat(ds)
-            dict_coord[f] = {
-                'lon': lon, 
-                'lat':lat,
-                }
-        df = self.dict_to_df(dict_coord)
-        return df
+        return self.get_metadata_index(var)[['lon', 'lat']]
 
 
     def dict_to_df(self, 
@@ -179,32 +634,26 @@ class ProcessStations(DataProcess):
         return ax
     
     def get_station_info(self, var):
-        paths = self.get_path_all_stations(var)
-
-        stations_list = []
-        for path in paths:
-            stations_list.append(self.load_station(path))
+        df = self.get_metadata_index(var)
 
         station_info = {}
-        for station in stations_list:
-            name = station.attrs['site name']
-            no = station.attrs['agent_number']
-            latitude = float(station['latitude'].values)
-            longitude = float(station['longitude'].values)
-            try:
-                elevation = float(station['station_height'].values)
-            except:
-                print('Missing elevation for station:', name, 'station_no:', station.attrs['agent_number'])
-                elevation = np.nan
-            station_info[name] = {'station_no': no,
-                                'latitude': latitude,
-                                'longitude': longitude,
-                                'elevation': elevation,}
+        for _, row in df.iterrows():
+            if np.isnan(row['elevation']):
+                print('Missing elevation for station:', row['station_name'], 'station_no:', row['station_no'])
+            station_info[row['station_name']] = {'station_no': row['station_no'],
+                                                 'latitude': row['lat'],
+                                                 'longitude': row['lon'],
+                                                 'elevation': row['elevation'],}
         return station_info
 
     def get_all_station_info(self):
         station_info_master = {}
+        subdirs = []
         for var in VARIABLE_OPTIONS:
+            # variables in the same subdir share station files
+            if VAR_STATIONS[var]['subdir'] in subdirs:
+                continue
+            subdirs.append(VAR_STATIONS[var]['subdir'])
             print(f'Getting {var} station info')
             station_info = self.get_station_info(var)
             for k, v in station_info.items():
@@ -233,38 +682,22 @@ class ProcessStations(DataProcess):
         """
         if isinstance(time, (list, np.ndarray)):
             time = np.array(time, dtype='datetime64[ns]')
-            def condition(lst, ds_time): return len(set(lst).intersection(ds_time)) != 0 
-
         else:
             if isinstance(time, pd.Timestamp):
                 time = np.datetime64(time.to_pydatetime())
             elif not isinstance(time, np.datetime64):
                 time = np.datetime64(time)
-            def condition(lst, ds_time): return lst in ds_time
         
-        pd_time = pd.DatetimeIndex(time)
-        paths = self.get_path_all_stations(var)
-
-        df_list = []
-        for path in tqdm(paths, desc='Loading stations'):
-            with xr.open_dataset(path) as ds:
-                station_name = ds.attrs['site name']
-                if condition(time, ds.time.values):
-                    da = self.ds_to_da(ds, var)
-                    df_station = da.to_dataframe()
-                    if daily: 
-                        if var == 'precipitation':
-                            df_station = df_station.reset_index().resample('D', on='time').sum()[[VAR_STATIONS[var]['var_name']]]
-                        else:
-                            df_station = df_station.reset_index().resample('D', on='time').mean()[[VAR_STATIONS[var]['var_name']]]
-                    df_station = df_station.loc[pd_time.intersection(df_station.index)]
-                    lon, lat = self.get_lon_lat(ds)
-                    df_station['longitude'] = lon
-                    df_station['latitude'] = lat
-                    df_station['station_name'] = station_name
-                    df_list.append(df_station)
+        pd_time = pd.DatetimeIndex(np.atleast_1d(time))
+
+        if self._store_available(var):
+            df_list = self._load_stations_time_store(var, pd_time, daily)
+        else:
+            df_list = self._load_stations_time_files(var, pd_time, daily)
         
         print(f'{len(df_list)} stations with data at prediction time(s)')
+        if len(df_list) == 0:
+            raise ValueError(f'No {var} stations have data between {pd_time.min()} and {pd_time.max()}')
                     
         df = pd.concat(df_list)
 
@@ -285,47 +718,497 @@ class ProcessStations(DataProcess):
             print(f'Kept {len(keep_stations)} stations')
 
         df = df.reset_index().rename(columns={'index': 'time'})
+        if self.compact:
+            df['station_name'] = df['station_name'].astype('category')
         df = df.set_index(['time', 'latitude', 'longitude', 'station_name'])
 
         df_column_name = df.columns[0]
         df = df.rename(columns={df_column_name: f"{var}_station"})
+        if self.compact:
+            df = df.astype({f"{var}_station": np.float32})
         
         return df
     
+    def _time_window(self, pd_time, daily=False):
+        """ (start, end) of the raw observations needed for times pd_time, whole days if daily """
+        start, end = pd_time.min(), pd_time.max()
+        if daily:
+            start, end = start.floor('D'), end.floor('D') + pd.Timedelta(days=1) - pd.Timedelta(1, 'ns')
+        return start, end
+
+
+    def _match_times(self, ds_time, times):
+        """ Positions of times in the sorted time axis ds_time, found by binary search """
+        if len(ds_time) == 0:
+            return np.array([], dtype=int)
+        pos = np.searchsorted(ds_time, times)
+        hits = (pos < len(ds_time)) & (ds_time[np.minimum(pos, len(ds_time) - 1)] == times)
+        return np.unique(pos[hits])
+
+
+    def _load_stations_time_files(self, var, pd_time, daily=False):
+        """
+        load_stations_time from the station files, returns list of station dataframes.
+        Stations whose time range (from the metadata index) doesn't overlap pd_time are skipped
+        without being opened, and only the matching rows of the others are decoded.
+        """
+        start, end = self._time_window(pd_time, daily)
+        df_md = self.get_metadata_index(var)
+        df_md = df_md[(df_md['start_time'] <= end) & (df_md['end_time'] >= start)]
+
+        load_fn = partial(self._load_station_time, var=var, pd_time=pd_time, daily=daily)
+        df_list = [df_station for df_station in self._load_files(load_fn, list(df_md.index)) 
+                   if df_station is not None]
+        if not daily or len(df_list) == 0:
+            return [df_station.drop(columns='station_id') for df_station in df_list]
+
+        df = self.aggregate_stations(pd.concat(df_list), var)
+        return self._split_stations(df[df.index.isin(pd_time)])
+
+
+    def _split_stations(self, df):
+        """ List of the dataframes of each station in df, without the station_id column """
+        return [df_station.drop(columns='station_id') 
+                for _, df_station in df.groupby('station_id', sort=False, observed=True)]
+
+
+    def _load_station_time(self, filepath, var, pd_time, daily=False):
+        """ Rows of one station file at times pd_time, None if the station has no data at those times """
+        times = pd_time.values
+        start, end = self._time_window(pd_time, daily)
+        with xr.open_dataset(filepath) as ds:
+            ds_time = ds['time'].values
+            idx = self._match_times(ds_time, times)
+            if len(idx) == 0:
+                return None
+            if daily:
+                # raw observations of the whole days, aggregated across all stations together afterwards
+                ds_window = ds.isel(time=slice(np.searchsorted(ds_time, start.to_datetime64()), 
+                                               np.searchsorted(ds_time, end.to_datetime64(), side='right')))
+            else:
+                ds_window = ds.isel(time=idx)
+            da = self.ds_to_da(ds_window, var)
+            df_station = da.to_dataframe()
+            lon, lat = self.get_lon_lat(ds)
+            df_station['longitude'] = lon
+            df_station['latitude'] = lat
+            df_station['station_name'] = ds.attrs['site name']
+        df_station['station_id'] = self.get_station_id(filepath)
+        return df_station
+
+
+    def _load_stations_time_store(self, var, pd_time, daily=False):
+        """ load_stations_time from the station store, returns list of station dataframes """
+        store = self.get_store(var)
+        start, end = self._time_window(pd_time, daily)
+        df_obs = store.read(columns=self._store_columns(var, store), start=start, end=end)
+
+        # only stations with an observation at one of the requested times
+        station_ids = df_obs.loc[df_obs['time'].isin(pd_time), 'station_id'].unique()
+        df_obs = df_obs[df_obs['station_id'].isin(station_ids)]
+        df = self._store_to_station_df(df_obs, var, store.read_stations())
+        if daily:
+            df = self.aggregate_stations(df, var)
+        return self._split_stations(df[df.index.isin(pd_time)])
+
+
     def get_wind_components(self,
                             ds: xr.Dataset,
+                            components: List[str] = ('u', 'v'),
                             ):
-
+        """ Copy of ds (xr.Dataset or pd.DataFrame) with the u and/or v wind components from speed and direction """
         W = ds['speed']
         theta_rad = np.deg2rad(ds['direction'])
-        ds['u'] = - W * np.sin(theta_rad)
-        ds['v'] = - W * np.cos(theta_rad)
-        return ds       
+        derived = {}
+        if 'u' in components:
+            derived['u'] = - W * np.sin(theta_rad)
+        if 'v' in components:
+            derived['v'] = - W * np.cos(theta_rad)
+        return ds.assign(**derived)
        
+    def iter_stations(self,
+                      var: Literal[tuple(VARIABLE_OPTIONS)],
+                      years: List[int],
+                      freq: str = 'MS',
+                      area: str = None,
+                      daily: bool = False,
+                      return_uv: bool = False,
+                      filepaths: List[str] = None,
+                      min_obs: int = None,
+                      return_counts: bool = False,
+                      ):
+        """
+        Generator of station observations in time ordered chunks (e.g. one per month), 
+        so multi-year loads only hold one year of observations in memory.
+        Each year is read in one pass (every station file or store partition once) and split into chunks.
+        Only stations whose time range (from the store's station table or the metadata index) overlaps the year are read.
+        Args:
+            var (str): variable
+            years (list): years to load
+            freq (str): pandas frequency of the chunk boundaries, e.g. 'MS' (monthly) or 'YS' (yearly).
+                Should be day aligned if daily=True
+            area (str): only stations inside PLOT_EXTENT[area]
+            daily (bool): resample to daily (mean)
+            return_uv (bool): return both wind components u and v
+            filepaths (list): only these station files (all stations if None)
+            min_obs (int), return_counts (bool): if daily, see load_station_dfs
+        Yields:
+            df: observations of one chunk, same layout as load_station_dfs, sorted by time
+        """
+        years = sorted(set([years] if isinstance(years, int) else years))
+        df_md = self._select_stations(var, area=area, filepaths=filepaths)
+
+        if self.compact:
+            # same categories in every chunk, so concatenated chunks stay categorical
+            categories = {'station_id': sorted(self.get_station_id(path) for path in df_md.index),
+                          'station_name': sorted(df_md['station_name'].unique())}
+
+        store = self.get_store(var) if self._store_available(var) else None
+        if store is not None:
+            columns = self._store_columns(var, store, return_uv)
+            df_stations = store.read_stations()
+
+        bounds = self._chunk_bounds(years, freq)
+        for year in years:
+            paths = list(df_md.index[self._overlaps_years(df_md, [year])])
+            if len(paths) == 0:
+                continue
+            if store is None:
+                df_year = self.load_station_dfs(paths, var, daily=daily, return_uv=return_uv, 
+                                                start=pd.Timestamp(f'{year}-01-01'), 
+                                                end=pd.Timestamp(f'{year + 1}-01-01') - pd.Timedelta(1, 'ns'),
+                                                min_obs=min_obs, return_counts=return_counts)
+            else:
+                df_year = self._read_store_df(store, var, [self.get_station_id(path) for path in paths],
+                                              columns=columns, df_stations=df_stations,
+                                              daily=daily, return_uv=return_uv, years=[year],
+                                              min_obs=min_obs, return_counts=return_counts)
+            if len(df_year) == 0:
+                continue
+            df_year = df_year.sort_index(kind='stable')
+            if self.compact:
+                for col, cats in categories.items():
+                    df_year[col] = df_year[col].cat.set_categories(sorted(set(cats) | set(df_year[col].cat.categories)))
+
+            times = df_year.index
+            for start, end in bounds:
+                if start.year != year:
+                    continue
+                df = df_year.iloc[times.searchsorted(start):times.searchsorted(end, side='right')]
+                if len(df) > 0:
+                    yield df
+
+
+    def _select_stations(self, 
+                         var: Literal[tuple(VARIABLE_OPTIONS)],
+                         area: str = None,
+                         filepaths: List[str] = None,
+                         ) -> pd.DataFrame:
+        """ 
+        Metadata of the stations to load, indexed by filepath with start_time and end_time columns.
+        From the store's station table if the store exists, otherwise from the metadata index.
+        """
+        df_md = self.get_store_metadata(var) if self._store_available(var) else self.get_metadata_index(var)
+        if filepaths is not None:
+            df_md = df_md[df_md['station_id'].isin([self.get_station_id(path) for path in filepaths])]
+        if area is not None:
+            df_md = df_md[StationIndex(df_md).in_area(area)]
+        return df_md
+
+
+    def _overlaps_years(self, df_md, years) -> np.ndarray:
+        """ Boolean mask of the stations in df_md with a time range overlapping any of years """
+        start_year = pd.to_datetime(df_md['start_time']).dt.year.values
+        end_year = pd.to_datetime(df_md['end_time']).dt.year.values
+        mask = np.zeros(len(df_md), dtype=bool)
+        for year in set(years):
+            mask |= (start_year <= year) & (end_year >= year)
+        return mask
+
+
+    def _chunk_bounds(self, years, freq):
+        """ (start, end) of each chunk of years, inclusive, with chunk boundaries at freq and year boundaries """
+        bounds = []
+        for year in sorted(set(years)):
+            year_start, year_end = pd.Timestamp(f'{year}-01-01'), pd.Timestamp(f'{year + 1}-01-01')
+            edges = pd.date_range(year_start, year_end, freq=freq).union([year_start, year_end])
+            bounds.extend([(edges[i], edges[i + 1] - pd.Timedelta(1, 'ns')) for i in range(len(edges) - 1)])
+        return bounds
+
+
+    def station_stats(self,
+                      var: Literal[tuple(VARIABLE_OPTIONS)],
+                      years: List[int],
+                      area: str = None,
+                      daily: bool = False,
+                      freq: str = 'MS',
+                      ) -> pd.DataFrame:
+        """
+        Count, mean, std (ddof=0), min and max of each observation column over years,
+        computed in one streaming pass over iter_stations (chunk statistics merged with Chan's method)
+        """
+        count, mean, m2, vmin, vmax = 0, 0., 0., None, None
+        for df in self.iter_stations(var, years, freq=freq, area=area, daily=daily):
+            values = df.drop(columns=['longitude', 'latitude', 'station_name', 'station_id'])
+            n = values.count()
+            if n.sum() == 0:
+                continue
+            chunk_mean = values.mean().fillna(0.)
+            chunk_m2 = ((values - values.mean()) ** 2).sum()
+            delta = chunk_mean - mean
+            total = count + n
+            mean = mean + delta * n / total.where(total > 0, 1)
+            m2 = m2 + chunk_m2 + delta ** 2 * count * n / total.where(total > 0, 1)
+            count = total
+            vmin = values.min() if vmin is None else np.fmin(vmin, values.min())
+            vmax = values.max() if vmax is None else np.fmax(vmax, values.max())
+        if vmin is None:
+            raise ValueError(f'No {var} station data for years {years}')
+        return pd.DataFrame({'count': count, 'mean': mean, 'std': np.sqrt(m2 / count), 'min': vmin, 'max': vmax})
+
+
+    def load_stations_years(self,
+                            var: Literal[tuple(VARIABLE_OPTIONS)],
+                            years: List[int],
+                            area: str = None,
+                            daily: bool = False,
+                            return_uv: bool = False,
+                            filepaths: List[str] = None,
+                            min_obs: int = None,
+                            return_counts: bool = False,
+                            ) -> pd.DataFrame:
+        """
+        All observations in years, read in a single pass (use iter_stations to bound memory).
+        Only stations whose time range overlaps years are read, and only the span of years.
+        Args: see iter_stations
+        Returns:
+            df: same layout as load_station_dfs, sorted by time
+        """
+        years = sorted(set([years] if isinstance(years, int) else years))
+        df_md = self._select_stations(var, area=area, filepaths=filepaths)
+        paths = list(df_md.index[self._overlaps_years(df_md, years)])
+        if len(paths) == 0:
+            raise ValueError(f'No {var} stations with observations in {years}')
+        df = self.load_station_dfs(paths, var, daily=daily, return_uv=return_uv, years=years,
+                                   start=pd.Timestamp(f'{years[0]}-01-01'),
+                                   end=pd.Timestamp(f'{years[-1] + 1}-01-01') - pd.Timedelta(1, 'ns'),
+                                   min_obs=min_obs, return_counts=return_counts)
+        df = df[df.index.year.isin(years)]
+        return df.sort_index(kind='stable')
+
+
     def load_stations(self, var, years, return_uv=False):
         if isinstance(years, int):
             years = [years]
 
-        stations_meta = self.get_metadata_df(var)
-        condition = stations_meta.apply(lambda row: any(year in range(row['start_year'], row['end_year'] + 1) for year in years), axis=1)
-        stations_filtered = stations_meta[condition]
-
-        df_list = []
-        for path in tqdm(list(stations_filtered.index), desc='Filtering stations'):
-            station_df = self.load_station_df(path, var, return_uv=return_uv)
-            df_list.append(station_df)
-
-        print('Concatenating stations into pd.DataFrame')
-        df = pd.concat(df_list)
+        df = self.load_stations_years(var, years, return_uv=return_uv)
+        df = df.drop(columns='station_id')
 
         station_df_ = df.reset_index()
-        station_df_ = station_df_[(station_df_['time']>=str(years[0])) &
-                                (station_df_['time']<=f'{str(years[-1])}-12-31')]
         station_df = station_df_.set_index(['time',
                                             'station_name',
                                             'latitude', 
                                             'longitude']).sort_index()
 
         return station_df
+
+
+class StationIndex:
+    """
+    Spatial index of station locations (haversine BallTree), built once and shared by 
+    nearest station, radius and bounding box queries. Distances are in km.
+    Query positions refer to the rows of self.stations.
+    The tree is only built for nearest and radius queries, bounding box queries also work with no stations.
+    """
+
+    EARTH_RADIUS_KM = 6371.0
+
+    def __init__(self,
+                 df: pd.DataFrame,
+                 ) -> None:
+        """
+        Args:
+            df (pd.DataFrame): one row per station, with latitude and longitude (or lat and lon) 
+                columns or index levels, e.g. from get_metadata_df
+        """
+        if 'latitude' not in df.columns and 'lat' not in df.columns:
+            df = df.reset_index()
+        lat_col, lon_col = ('latitude', 'longitude') if 'latitude' in df.columns else ('lat', 'lon')
+        self.stations = df
+        self.latitude = df[lat_col].values.astype(float)
+        self.longitude = df[lon_col].values.astype(float)
+        self._tree = None
+
+
+    @property
+    def tree(self) -> BallTree:
+        if self._tree is None:
+            if len(self) == 0:
+                raise ValueError('No stations in the StationIndex')
+            self._tree = BallTree(np.radians(np.column_stack([self.latitude, self.longitude])), metric='haversine')
+        return self._tree
+
+
+    @classmethod
+    def from_observations(cls,
+                          df: pd.DataFrame,
+                          ) -> 'StationIndex':
+        """ Index of the unique station locations in long format observations indexed by (time, latitude, longitude) """
+        locs = df.index.to_frame(index=False) if 'latitude' in df.index.names else df
+        return cls(locs[['latitude', 'longitude']].drop_duplicates().reset_index(drop=True))
+
+
+    def __len__(self) -> int:
+        return len(self.latitude)
+
+
+    def _to_radians(self, lat, lon) -> np.ndarray:
+        return np.radians(np.column_stack([np.atleast_1d(lat).astype(float), np.atleast_1d(lon).astype(float)]))
+
+
+    def query(self, lat, lon, k: int = 1) -> tuple:
+        """ Distances (km) and positions of the k nearest stations to each point, both of shape (n_points, k) """
+        dist, idx = self.tree.query(self._to_radians(lat, lon), k=min(k, len(self)))
+        return dist * self.EARTH_RADIUS_KM, idx
+
+
+    def nearest(self, lat, lon) -> np.ndarray:
+        """ (latitude, longitude) of the nearest station to each point, shape (n_points, 2) """
+        _, idx = self.query(lat, lon, k=1)
+        return np.column_stack([self.latitude[idx[:, 0]], self.longitude[idx[:, 0]]])
+
+
+    def nearest_available(self, lat, lon, available: np.ndarray) -> np.ndarray:
+        """ Position of the nearest station to each point among stations where available is True """
+        if not available.any():
+            raise ValueError('No available stations')
+        lat, lon = np.atleast_1d(lat), np.atleast_1d(lon)
+        result = np.full(len(lat), -1)
+        todo = np.arange(len(lat))
+        k = 8
+        while len(todo) > 0:
+            _, idx = self.query(lat[todo], lon[todo], k=k)
+            hit = available[idx]
+            found = hit.any(axis=1)
+            result[todo[found]] = idx[found, hit[found].argmax(axis=1)]
+            todo = todo[~found]
+            k *= 4
+        return result
+
+
+    def query_radius(self, lat, lon, radius_km: float) -> List[np.ndarray]:
+        """ Positions of the stations within radius_km of each point """
+        return list(self.tree.query_radius(self._to_radians(lat, lon), r=radius_km / self.EARTH_RADIUS_KM))
+
+
+    def in_bbox(self, minlon, maxlon, minlat, maxlat) -> np.ndarray:
+        """ Boolean mask of the stations strictly inside the bounding box """
+        return ((self.longitude > minlon) & (self.longitude < maxlon) & 
+                (self.latitude > minlat) & (self.latitude < maxlat))
+
+
+    def in_area(self, area: str) -> np.ndarray:
+        """ Boolean mask of the stations inside PLOT_EXTENT[area] """
+        extent = PLOT_EXTENT[area]
+        return self.in_bbox(extent['minlon'], extent['maxlon'], extent['minlat'], extent['maxlat'])
+
+
+    def locate(self, lat, lon) -> np.ndarray:
+        """ Positions of stations at exactly (lat, lon), -1 where there is none """
+        locs = pd.MultiIndex.from_arrays([self.latitude, self.longitude])
+        return locs.get_indexer(pd.MultiIndex.from_arrays([np.atleast_1d(lat).astype(float), 
+                                                           np.atleast_1d(lon).astype(float)]))
+
+
+class StationArray:
+    """
+    Station observations as a dense (time x station) float array, plus a station table 
+    (latitude, longitude, station_name). Missing observations are NaN, see mask.
+    Use to_dataframe to get the long format DeepSensor expects, indexed by (time, latitude, longitude).
+    """
+
+    def __init__(self,
+                 values: np.ndarray,
+                 times,
+                 stations: pd.DataFrame,
+                 var_name: str,
+                 ) -> None:
+        self.values = values
+        self.times = pd.DatetimeIndex(times, name='time')
+        self.stations = stations
+        self.var_name = var_name
+
+
+    @classmethod
+    def from_dataframe(cls,
+                       df: pd.DataFrame,
+                       column: str = None,
+                       dtype=None,
+                       ) -> 'StationArray':
+        """
+        Args:
+            df (pd.DataFrame): long format station data with time, latitude and longitude 
+                in the index or columns, and optionally station_name
+            column (str): observation column, first column of df if None
+            dtype: dtype of the array, e.g. np.float32 to halve memory. If None, the dtype of column 
+                (float64 for integer columns, so missing values can be NaN)
+        Stations are identified by (latitude, longitude), if a station has duplicate times the first is kept.
+        """
+        if column is None:
+            column = df.columns[0]
+        if dtype is None:
+            dtype = df[column].dtype if np.issubdtype(df[column].dtype, np.floating) else np.float64
+        df = df.reset_index()
+
+        time_codes, times = pd.factorize(df['time'], sort=True)
+        latlon = pd.MultiIndex.from_arrays([df['latitude'], df['longitude']])
+        station_codes, latlon_unique = pd.factorize(latlon, sort=True)
+        n_times, n_stations = len(times), len(latlon_unique)
+
+        flat_idx = time_codes.astype(np.int64) * n_stations + station_codes
+        _, first = np.unique(flat_idx, return_index=True)
+        values = np.full((n_times, n_stations), np.nan, dtype=dtype)
+        values.flat[flat_idx[first]] = df[column].values[first]
+
+        stations = pd.DataFrame({'latitude': latlon_unique.get_level_values(0), 
+                                 'longitude': latlon_unique.get_level_values(1)})
+        if 'station_name' in df.columns:
+            stations['station_name'] = df.groupby(station_codes, observed=True)['station_name'].first().values
+        return cls(values, times, stations, column)
+
+
+    @property
+    def mask(self) -> np.ndarray:
+        """ True where there is an observation """
+        return ~np.isnan(self.values)
+
+
+    def sel_time(self, times) -> 'StationArray':
+        """ Subset to times (must all be in self.times) """
+        idx = self.times.get_indexer(pd.DatetimeIndex(np.atleast_1d(times)))
+        if (idx < 0).any():
+            raise KeyError('Not all times are in the StationArray')
+        return StationArray(self.values[idx], self.times[idx], self.stations, self.var_name)
+
+
+    def to_dataframe(self, times=None) -> pd.DataFrame:
+        """ Long format, every station at every time (NaN where missing), indexed by (time, latitude, longitude) """
+        arr = self if times is None else self.sel_time(times)
+        n_times, n_stations = arr.values.shape
+        index = pd.MultiIndex.from_arrays([np.repeat(arr.times, n_stations),
+                                           np.tile(arr.stations['latitude'].values, n_times),
+                                           np.tile(arr.stations['longitude'].values, n_times)],
+                                          names=['time', 'latitude', 'longitude'])
+        df = pd.DataFrame({arr.var_name: arr.values.ravel()}, index=index)
+        if 'station_name' in arr.stations.columns:
+            names = arr.stations['station_name']
+            if isinstance(names.dtype, pd.CategoricalDtype):
+                df['station_name'] = pd.Categorical.from_codes(np.tile(names.cat.codes.values, n_times), 
+                                                               categories=names.cat.categories)
+            else:
+                df['station_name'] = np.tile(names.values, n_times)
+        return df
+
+
 if __name__ == '__main__':
     pass
\ No newline at end of file
@@ -1,6 +1,9 @@
 import os
 from typing_extensions import Literal, Union
 import pickle
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from dask.distributed import Client
 import numpy as np
 import xarray as xr
@@ -31,6 +34,50 @@ def rmse(y_true, y_pred):
     return np.sqrt(np.mean((y_true - y_pred)**2))
 
 
+def load_parallel(load_fn, 
+                  items: list, 
+                  n_workers: int = 1, 
+                  use_processes: bool = False,
+                  desc: str = 'Loading',
+                  ):
+    """
+    Apply load_fn to every item, fanned out over a bounded pool of threads or processes.
+    Args:
+        load_fn (callable): load_fn(item), must be picklable if use_processes=True
+        items (list): e.g. filepaths
+        n_workers (int): size of the worker pool, runs serially if 1 (or None)
+        use_processes (bool): use a process pool instead of a thread pool
+        desc (str): progress bar description
+    Returns:
+        results (list): load_fn(item) for every item that succeeded, in the order of items
+        failures (dict): item -> repr of the exception raised, for every item that failed
+    """
+    items = list(items)
+    results = [None] * len(items)
+    failures = {}
+
+    if n_workers is None or n_workers <= 1:
+        for i, item in enumerate(tqdm(items, desc=desc)):
+            try:
+                results[i] = load_fn(item)
+            except Exception as e:
+                failures[i] = repr(e)
+    else:
+        executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        with executor_class(max_workers=n_workers) as executor:
+            futures = {executor.submit(load_fn, item): i for i, item in enumerate(items)}
+            for future in tqdm(as_completed(futures), total=len(futures), desc=desc):
+                i = futures[future]
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    failures[i] = repr(e)
+
+    results = [result for i, result in enumerate(results) if i not in failures]
+    failures = {items[i]: error for i, error in sorted(failures.items())}
+    return results, failures
+
+
 class ProgressBar(Callback):
     def __init__(self, desc=""):
         self.desc = desc
@@ -51,6 +98,190 @@ class Caching:
         pass
 
 
+class FileIndex:
+    """
+    Persistent index of per-file records (e.g. station metadata), indexed by filepath.
+    On refresh only files that are new, or whose mtime or size changed, are re-read.
+    Saved as a pickled pd.DataFrame at filepath, or kept in memory only if filepath is None.
+    """
+
+    def __init__(self, 
+                 filepath: str = None,
+                 columns: list = None,
+                 ) -> None:
+        """
+        Args:
+            filepath (str): pickle file of the index, or None to keep it in memory
+            columns (list): record columns returned by read_fn, so refresh returns them even when
+                no file could be read
+        """
+        self.filepath = filepath
+        self.columns = columns
+        self.df = None
+
+
+    def load(self) -> pd.DataFrame:
+        """ Full index, including files that could not be read """
+        if self.df is None:
+            if self.filepath is not None and os.path.exists(self.filepath):
+                self.df = open_pickle(self.filepath)
+            else:
+                self.df = pd.DataFrame(columns=list(self.columns or []) + ['mtime', 'size', 'error'])
+        return self.df
+
+
+    def save(self) -> None:
+        """ Atomic write, so concurrent jobs never read a partially written index """
+        if self.filepath is None:
+            return
+        os.makedirs(os.path.dirname(self.filepath), exist_ok=True)
+        tmp_filepath = f'{self.filepath}.{os.getpid()}.tmp'
+        save_pickle(self.df, tmp_filepath)
+        os.replace(tmp_filepath, self.filepath)
+
+
+    def refresh(self,
+                paths: list,
+                read_fn,
+                desc: str = 'Indexing files',
+                n_workers: int = 1,
+                use_processes: bool = False,
+                ) -> pd.DataFrame:
+        """
+        Update the index for paths and return their records
+        Args:
+            paths (list): filepaths to index, files no longer in paths are dropped
+            read_fn (callable): read_fn(path) -> dict of record values
+            desc (str): progress bar description
+            n_workers (int), use_processes (bool): worker pool used to read stale files, see load_parallel
+        Returns:
+            df: one row per readable file in paths, in the order of paths
+        """
+        df = self.load()
+        stats = {path: os.stat(path) for path in paths}
+        stale = [path for path, st in stats.items()
+                 if path not in df.index
+                 or df.at[path, 'mtime'] != st.st_mtime
+                 or df.at[path, 'size'] != st.st_size]
+        removed = df.index.difference(list(stats.keys()))
+
+        if len(stale) > 0 or len(removed) > 0:
+            results, failures = load_parallel(read_fn, stale, n_workers=n_workers, 
+                                              use_processes=use_processes, desc=desc)
+            results = iter(results)
+            records = {}
+            for path in stale:
+                if path in failures:
+                    record = {'error': failures[path]}
+                else:
+                    record = next(results)
+                    record['error'] = None
+                record['mtime'] = stats[path].st_mtime
+                record['size'] = stats[path].st_size
+                records[path] = record
+
+            df = df.drop(index=removed.union(df.index.intersection(stale)))
+            df_new = pd.DataFrame.from_dict(records, orient='index')
+            if len(df_new) == 0:
+                # only removals
+                df_new = pd.DataFrame(columns=list(self.columns or []) + ['mtime', 'size', 'error'])
+            df = df_new if len(df) == 0 else pd.concat([df, df_new])
+            self.df = df
+            self.save()
+
+        df = df.loc[[path for path in paths if path in df.index]]
+        df = df[df['error'].isna()]
+        df = df.drop(columns=['mtime', 'size', 'error'])
+        if self.columns is not None:
+            df = df.reindex(columns=self.columns)
+        return df
+
+
+class DatasetPool:
+    """
+    Size-bounded LRU cache of open (lazy) datasets, keyed by e.g. (source, variable, files).
+    Reusing a pooled dataset skips re-opening its files and re-decoding their metadata.
+    The least recently used datasets are closed once more than max_datasets datasets 
+    or max_files files are open. Pooled datasets are shared, don't close or modify them in place.
+    """
+
+    def __init__(self,
+                 max_datasets: int = 8,
+                 max_files: int = 512,
+                 ) -> None:
+        self.max_datasets = max_datasets
+        self.max_files = max_files
+        self._datasets = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self,
+            key: tuple,
+            open_fn,
+            n_files: int = 1,
+            ) -> xr.Dataset:
+        """ Dataset for key, opened with open_fn() if it is not in the pool """
+        with self._lock:
+            if key in self._datasets:
+                self._datasets.move_to_end(key)
+                self.hits += 1
+                return self._datasets[key][0]
+        ds = open_fn()
+        with self._lock:
+            self.misses += 1
+            if key in self._datasets:
+                # another thread opened it first, keep theirs and close ours
+                self._datasets.move_to_end(key)
+                pooled = self._datasets[key][0]
+            else:
+                self._datasets[key] = (ds, n_files)
+                self._evict()
+                return ds
+        ds.close()
+        return pooled
+
+
+    def open_mfdataset(self,
+                       key: tuple,
+                       filenames: list,
+                       **kwargs,
+                       ) -> xr.Dataset:
+        """ Pooled xr.open_mfdataset(filenames, **kwargs), keyed by key and the set of filenames """
+        key = (*key, tuple(sorted(filenames)))
+        return self.get(key, lambda: xr.open_mfdataset(filenames, **kwargs), n_files=len(filenames))
+
+
+    def _evict(self) -> None:
+        n_files = sum(n for _, n in self._datasets.values())
+        while len(self._datasets) > 1 and (len(self._datasets) > self.max_datasets or n_files > self.max_files):
+            _, (ds, n) = self._datasets.popitem(last=False)
+            ds.close()
+            n_files -= n
+
+
+    def clear(self) -> None:
+        """ Close all pooled datasets """
+        with self._lock:
+            for ds, _ in self._datasets.values():
+                ds.close()
+            self._datasets.clear()
+
+
+    def __len__(self) -> int:
+        return len(self._datasets)
+
+
+# shared by all ProcessERA5 and ProcessWRF instances in the process
+DATASET_POOL = DatasetPool()
+
+
+def _resample_daily(ds, function: str):
+    """ Daily mean or sum of hourly data, also applied to each day-aligned chunk by map_blocks """
+    return getattr(ds.resample(time='D'), function)()
+
+
 class DataProcess:
     def __init__(self) -> None:
         pass
@@ -105,6 +336,63 @@ class DataProcess:
             return da.coarsen(latitude=coarsen_by, longitude=coarsen_by, boundary=boundary).mean()
 
 
+    def convert_hourly_to_daily(self,
+                                ds,
+                                function: Literal['mean', 'sum'] = 'mean',
+                                days_per_chunk: int = 31,
+                                out_path: str = None,
+                                ):
+        """
+        Aggregate hourly data to daily means or sums.
+        Dask backed data is rechunked on day boundaries and each chunk is reduced on its own with
+        map_blocks, so only days_per_chunk days of hourly data are in memory per task.
+        Args:
+            ds (xr.Dataset or xr.DataArray): hourly data with a time dimension
+            function (str): 'mean' or 'sum'
+            days_per_chunk (int): number of days in each chunk
+            out_path (str): if set, the daily data is written chunk by chunk to this Zarr store and
+                returned opened lazily from it
+        """
+        if function not in ['mean', 'sum']:
+            raise ValueError(f'function={function} not recognised')
+
+        variables = ds.variables.values() if isinstance(ds, xr.Dataset) else [ds.variable]
+        is_dask = any(v.chunks is not None for v in variables)
+        if not is_dask and out_path is None:
+            return _resample_daily(ds, function)
+
+        days = ds['time'].dt.floor('D').values
+        day_starts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]])
+        bounds = np.r_[day_starts[::days_per_chunk], len(days)]
+        ds = ds.chunk({'time': tuple(np.diff(bounds))})
+
+        unique_days = days[day_starts]
+        if np.all(np.diff(unique_days) == np.timedelta64(1, 'D')):
+            n_days = len(unique_days)
+            # the first day sets the names, dims and dtypes of the daily output
+            template = _resample_daily(ds.isel(time=slice(0, bounds[1])), function).isel(time=[0])
+            template = template.isel(time=np.zeros(n_days, dtype=int)).assign_coords(time=unique_days)
+            template = template.chunk({'time': tuple(np.diff(np.r_[np.arange(0, n_days, days_per_chunk), n_days]))})
+            ds_daily = xr.map_blocks(_resample_daily, ds, kwargs={'function': function}, template=template)
+        else:
+            # gaps in the record, resample fills missing days so the chunks can't be mapped one to one
+            ds_daily = _resample_daily(ds, function)
+
+        if out_path is None:
+            return ds_daily
+
+        is_da = isinstance(ds_daily, xr.DataArray)
+        if is_da:
+            name = ds_daily.name if ds_daily.name is not None else '__xarray_dataarray_variable__'
+            ds_daily = ds_daily.to_dataset(name=name)
+        for v in ds_daily.variables.values():
+            v.encoding = {}
+        with ProgressBar(desc=f'Writing daily {function}'):
+            ds_daily.to_zarr(out_path, mode='w', consolidated=True)
+        ds_daily = xr.open_zarr(out_path)
+        return ds_daily[name] if is_da else ds_daily
+
+
     def rename_xarray_coords(self,
                              da,
                              rename_dict: dict,
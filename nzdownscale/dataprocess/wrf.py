@@ -1,22 +1,25 @@
 import os
+import re
+import hashlib
 from types import NoneType
 from typing import Literal, List
 import glob
 from scipy.interpolate import griddata
 
 import xarray as xr
+import zarr
+import netCDF4
 from datetime import datetime, timedelta
-from scipy.interpolate import LinearNDInterpolator
 import numpy as np
-from functools import partial
+import pandas as pd
 from tqdm import tqdm
 import dask.array as da
 from dask import delayed, compute
 from dask.distributed import Client, LocalCluster
-import xesmf as xe
 
-from nzdownscale.dataprocess.utils import DataProcess
-from nzdownscale.dataprocess.config import VARIABLE_OPTIONS, VAR_WRF
+from nzdownscale.dataprocess.utils import DataProcess, FileIndex, DATASET_POOL
+from nzdownscale.dataprocess.regrid import get_regridder, regrid_parallel
+from nzdownscale.dataprocess.config import VARIABLE_OPTIONS, VAR_WRF, PLOT_EXTENT
 from nzdownscale.dataprocess.config_local import DATA_PATHS
 
 from dask.diagnostics import ProgressBar
@@ -53,6 +56,156 @@ def generate_datetimes(start_str: str, end_str: str, val_day:str=None, interval_
     return datetimes
 
 
+def get_regridded_dir() -> str:
+    """ Directory of regridded WRF Zarr stores, DATA_PATHS['wrf']['regridded'] or a subfolder of DATA_PATHS['cache'] """
+    if 'regridded' in DATA_PATHS['wrf'].keys():
+        return DATA_PATHS['wrf']['regridded']
+    if 'cache' in DATA_PATHS.keys():
+        return f'{DATA_PATHS["cache"]}/wrf'
+    raise ValueError("Please set 'regridded' in DATA_PATHS['wrf'] or a 'cache' path in DATA_PATHS dict e.g. 'cache':'data/.datacache', or pass out_path")
+
+
+def parse_wrf_filename(filepath: str) -> dict:
+    """ Domain and valid time of a WRF output file e.g. wrfout_d02_2020-01-01_06:00:00, None if not a WRF file """
+    match = re.search(r'_(d\d{2})_(\d{4}-\d{2}-\d{2}_\d{2}:\d{2}:\d{2})', os.path.basename(filepath))
+    if match is None:
+        return None
+    return {'domain': match.group(1),
+            'valid_time': pd.to_datetime(match.group(2), format='%Y-%m-%d_%H:%M:%S')}
+
+
+class WRFCatalog:
+    """
+    Persistent catalog of WRF forecast files, one row per file: 
+    model, init_time, lead (hours), domain, valid_time and filepath.
+    Forecast directories, {parent}/{year}/{month}/{init}/{model}/ or {parent}/{year}/{init}/,
+    are kept in a FileIndex and only re-listed when new, or when their mtime changes (files added).
+    Kept on disk in DATA_PATHS['cache'] if set (and use_cache=True), otherwise in memory.
+    The file rows are kept on the instance and only rebuilt when a forecast directory changed, 
+    use get_wrf_catalog to share one catalog within a process.
+    """
+
+    def __init__(self,
+                 parent: str = None,
+                 use_cache: bool = True,
+                 ) -> None:
+        self.parent = DATA_PATHS['wrf']['parent'] if parent is None else parent
+        if use_cache and 'cache' in DATA_PATHS.keys():
+            digest = hashlib.sha1(os.path.abspath(self.parent).encode()).hexdigest()[:12]
+            filepath = f'{DATA_PATHS["cache"]}/wrf/catalog_{digest}.pkl'
+        else:
+            filepath = None
+        self.index = FileIndex(filepath)
+        self._df = None
+        self._df_dirs = None
+
+
+    def find_forecast_dirs(self) -> List[str]:
+        """ All forecast directories under parent, directories only, files are not listed """
+        dirs = glob.glob(f'{self.parent}/[0-9]*/[0-9]*/[0-9]*/*/') + glob.glob(f'{self.parent}/[0-9]*/[0-9]*/')
+        return sorted(d.rstrip('/') for d in dirs if self._dir_init_model(d) is not None)
+
+
+    def _dir_init_model(self, dirpath: str):
+        """ (init, model) from the directory name, model is None for {year}/{init}/ directories """
+        parts = dirpath.rstrip('/').split('/')
+        if re.fullmatch(r'\d{10}', parts[-1]):
+            return parts[-1], None
+        if len(parts) > 1 and re.fullmatch(r'\d{10}', parts[-2]):
+            return parts[-2], parts[-1]
+        return None
+
+
+    def _read_forecast_dir(self, dirpath: str) -> dict:
+        init, model = self._dir_init_model(dirpath)
+        files = sorted(os.path.basename(f) for f in glob.glob(f'{dirpath}/*_d[0-9][0-9]_*'))
+        return {'init': init, 'model': model, 'files': files}
+
+
+    def refresh(self) -> pd.DataFrame:
+        """ 
+        Returns:
+            df: one row per WRF file, sorted by init_time, model, domain and lead
+        """
+        self.index.refresh(self.find_forecast_dirs(), 
+                           self._read_forecast_dir, 
+                           desc='Indexing WRF forecasts')
+        # the FileIndex only replaces its frame when a directory was added, changed or removed
+        if self._df is not None and self._df_dirs is self.index.df:
+            return self._df
+        df_dirs = self.index.df[self.index.df['error'].isna()]
+        records = []
+        for dirpath, row in df_dirs.iterrows():
+            init_time = pd.to_datetime(row['init'], format='%Y%m%d%H')
+            for filename in row['files']:
+                info = parse_wrf_filename(filename)
+                if info is None:
+                    continue
+                records.append({'model': row['model'], 
+                                'init_time': init_time,
+                                'lead': int((info['valid_time'] - init_time) / pd.Timedelta(hours=1)),
+                                'domain': info['domain'],
+                                'valid_time': info['valid_time'],
+                                'filepath': f'{dirpath}/{filename}',
+                                })
+        columns = ['model', 'init_time', 'lead', 'domain', 'valid_time', 'filepath']
+        df = pd.DataFrame.from_records(records, columns=columns)
+        self._df = df.sort_values(['init_time', 'model', 'domain', 'lead'], ignore_index=True)
+        self._df_dirs = self.index.df
+        return self._df
+
+
+    def query(self,
+              init_times: list = None,
+              start=None,
+              end=None,
+              lead_min: int = None,
+              lead_max: int = None,
+              model: str = None,
+              domain: str = 'd02',
+              ) -> pd.DataFrame:
+        """
+        Files matching every filter given
+        Args:
+            init_times (list): forecast initialisation times
+            start, end: valid times within [start, end]
+            lead_min, lead_max (int): lead hours within [lead_min, lead_max]
+            model (str): e.g. 'nz4kmN-ECMWF-SIGMA', files in {year}/{init}/ directories (no model) always match
+            domain (str): e.g. 'd02', all domains if None
+        Returns:
+            df: model, init_time, lead, domain, valid_time and filepath, sorted by init_time and lead
+        """
+        df = self.refresh()
+        mask = np.ones(len(df), dtype=bool)
+        if init_times is not None:
+            mask &= df['init_time'].isin(pd.to_datetime(list(init_times)))
+        if start is not None:
+            mask &= df['valid_time'] >= pd.Timestamp(start)
+        if end is not None:
+            mask &= df['valid_time'] <= pd.Timestamp(end)
+        if lead_min is not None:
+            mask &= df['lead'] >= lead_min
+        if lead_max is not None:
+            mask &= df['lead'] <= lead_max
+        if model is not None:
+            mask &= (df['model'] == model) | df['model'].isna()
+        if domain is not None:
+            mask &= df['domain'] == domain
+        return df[mask]
+
+
+# shared by every caller in this process, keyed by parent directory
+WRF_CATALOGS = {}
+
+
+def get_wrf_catalog(parent: str = None) -> WRFCatalog:
+    """ WRFCatalog of parent (DATA_PATHS['wrf']['parent'] if None), created once per process """
+    parent = DATA_PATHS['wrf']['parent'] if parent is None else parent
+    if parent not in WRF_CATALOGS:
+        WRF_CATALOGS[parent] = WRFCatalog(parent)
+    return WRF_CATALOGS[parent]
+
+
 def get_filepaths(start_init, end_init, val_day=None,
                   model='nz4kmN-ECMWF-SIGMA'):
     """
@@ -69,29 +222,36 @@ def get_filepaths(start_init, end_init, val_day=None,
         ValueError(f'Model {model} not yet implemented')
     
     sub_dirs = generate_datetimes(start_init, end_init, val_day=val_day, interval_hours=interval_hours)
-    wrf_base = DATA_PATHS["wrf"]["parent"]
+    init_times = [datetime.strptime(subdir, '%Y%m%d%H') for subdir in sub_dirs]
 
-    paths = []
-    for subdir in sub_dirs:
-        subdir_dt = datetime.strptime(subdir, '%Y%m%d%H')
-        if 'mnt' in wrf_base:
-            fpath = f'{wrf_base}/{subdir_dt.year}/{str(subdir_dt.month).zfill(2)}/{subdir}/nz4kmN-ECMWF-SIGMA/'
-        else:
-            fpath = f'{wrf_base}/{subdir_dt.year}/{subdir}/'
-        files = glob.glob(f'{fpath}*d02*00')
-        files = sorted(files)[6:30] # just take the 6-30th files for training
-        # we ignore the first 6 as they are spin up
-        # we then take the next 24 hours so the model learns diurnal cycle
-        paths.extend(files)
-    print('Also only using the 6th-30th files from each directory')
+    # lead hours 6-29 for training
+    # we ignore the first 6 as they are spin up
+    # we then take the next 24 hours so the model learns diurnal cycle
+    df = get_wrf_catalog().query(init_times=init_times, lead_min=6, lead_max=29, model=model)
+    print('Also only using lead hours 6-29 from each forecast')
     
-    return paths
+    return list(df['filepath'])
 
 
 class ProcessWRF(DataProcess):
 
-    def __init__(self) -> None:
+    def __init__(self,
+                 use_pool: bool = True,
+                 n_workers: int = 1,
+                 direct_read: bool = False,
+                 ) -> None:
+        """
+        Args:
+            use_pool (bool): load_ds reuses open datasets from the process-wide DATASET_POOL
+            n_workers (int): number of threads regridding chunks of the time axis in parallel
+            direct_read (bool): load_ds and load_regridded read files with read_wrf_files 
+                instead of xr.open_mfdataset
+        """
         super().__init__()
+        self.use_pool = use_pool
+        self.n_workers = n_workers
+        self.direct_read = direct_read
+        self.catalog = None
 
     def _preprocess_load(self, ds, vars):
         """
@@ -130,18 +290,26 @@ class ProcessWRF(DataProcess):
             filenames = self.get_filenames(years, months, subdirs=subdirs)
 
         wrf_vars = [VAR_WRF[var]['var_name'] for var in context_variables]
+        if self.direct_read:
+            return self.read_wrf_files(filenames, wrf_vars)
         partial_preprocess = lambda ds: self._preprocess_load(ds, wrf_vars)
 
 
+        open_kwargs = dict(preprocess = partial_preprocess,
+                           parallel = True,
+                           concat_dim='Time',
+                           engine = 'netcdf4',
+                           combine = 'nested'
+                           )
         with ProgressBar():
             try:
-                ds = xr.open_mfdataset(filenames, 
-                                    preprocess = partial_preprocess,
-                                    parallel = True,
-                                    concat_dim='Time',
-                                    engine = 'netcdf4',
-                                    combine = 'nested'
-                                    )
+                if self.use_pool:
+                    # nested combine depends on file order, so it is part of the key
+                    ds = DATASET_POOL.get(('wrf', tuple(wrf_vars), tuple(filenames)), 
+                                          lambda: xr.open_mfdataset(filenames, **open_kwargs),
+                                          n_files=len(filenames))
+                else:
+                    ds = xr.open_mfdataset(filenames, **open_kwargs)
             except Exception as e:
                 print(f'Error loading dataset: {e}')
                 # Find the file that is causing the error
@@ -155,9 +323,66 @@ class ProcessWRF(DataProcess):
         #     ds.sel(Time=time)
         print('Loading data from dask')
         with ProgressBar():
-            ds = ds.load()
+            # compute returns a loaded copy, pooled datasets stay lazy
+            ds = ds.compute()
         return ds
 
+    def read_wrf_files(self,
+                       filenames: List[str],
+                       wrf_vars: List[str],
+                       progress: bool = True,
+                       ) -> xr.Dataset:
+        """
+        Read wrf_vars from WRF files directly with netCDF4, without xarray decoding every file's 
+        metadata and coordinates or building a dask graph to concatenate them.
+        Values are copied file by file into preallocated float32 (Time, ...) arrays. XTIME is read 
+        from every file, XLAT and XLONG once per forecast (directory) and returned as 
+        (south_north, west_east) coordinates, so all forecasts must be on the same grid.
+        Args:
+            filenames (list): WRF files in time order, each with the same number of times
+            wrf_vars (list): WRF variable names e.g. ['T2']
+            progress (bool): show a progress bar
+        """
+        with netCDF4.Dataset(filenames[0]) as nc:
+            n_file_times = len(nc.dimensions['Time'])
+            dims = {var: nc[var].dimensions for var in wrf_vars + ['XLAT']}
+            shapes = {var: nc[var].shape[1:] for var in wrf_vars}
+            attrs = {var: {k: nc[var].getncattr(k) for k in nc[var].ncattrs() 
+                              if not k.startswith('_') and k != 'coordinates'} 
+                     for var in wrf_vars}
+
+        n_times = n_file_times * len(filenames)
+        values = {var: np.empty((n_times,) + shapes[var], dtype=np.float32) for var in wrf_vars}
+        times = np.empty(n_times, dtype='datetime64[ns]')
+        xlat, xlong, forecast_dir = None, None, None
+        for i, filename in enumerate(tqdm(filenames, desc='Reading WRF files', disable=not progress)):
+            with netCDF4.Dataset(filename) as nc:
+                if len(nc.dimensions['Time']) != n_file_times:
+                    raise ValueError(f'{filename} has {len(nc.dimensions["Time"])} times, expected {n_file_times}')
+                sl = slice(i * n_file_times, (i + 1) * n_file_times)
+                for var in wrf_vars:
+                    # masked (fill) values become NaN, as when decoded by xarray
+                    values[var][sl] = np.ma.filled(nc[var][:], np.nan)
+                xtime = nc['XTIME']
+                # decoded as xarray does, float minutes are rounded the same way
+                times[sl] = xr.coding.times.decode_cf_datetime(xtime[:], xtime.units, 
+                                                               getattr(xtime, 'calendar', 'standard'))
+
+                if os.path.dirname(filename) != forecast_dir:
+                    forecast_dir = os.path.dirname(filename)
+                    lat, lon = np.ma.filled(nc['XLAT'][0], np.nan), np.ma.filled(nc['XLONG'][0], np.nan)
+                    if xlat is None:
+                        xlat, xlong = lat, lon
+                    elif not (np.array_equal(lat, xlat) and np.array_equal(lon, xlong)):
+                        raise ValueError(f'WRF grid of {forecast_dir} differs from the first forecast')
+
+        coords = {'XTIME': ('Time', times),
+                  'XLAT': (dims['XLAT'][1:], xlat),
+                  'XLONG': (dims['XLAT'][1:], xlong),
+                  }
+        return xr.Dataset({var: (dims[var], values[var], attrs[var]) for var in wrf_vars}, coords=coords)
+
+
     def ds_to_da(self,
                  ds: xr.Dataset,
                  var: Literal[tuple(VARIABLE_OPTIONS)],
@@ -175,18 +400,6 @@ class ProcessWRF(DataProcess):
         return da
 
 
-    def convert_hourly_to_daily(self, 
-                                ds, 
-                                function:Literal['mean', 'sum']='mean'):
-        if function == 'mean':
-            ds = ds.resample(time='D').mean()
-        elif function == 'sum':
-            ds = ds.resample(time='D').sum()
-        else:
-            raise ValueError(f'function={function} not recognised')
-        return ds
-    
-
     def coarsen_da(self, da: xr.DataArray, coarsen_by: int, boundary: str = 'trim'):
         return super().coarsen_da(da, coarsen_by, boundary)
 
@@ -197,20 +410,24 @@ class ProcessWRF(DataProcess):
                         model: str='nz4kmN-ECMWF-SIGMA',
                         subdirs: List[str] = None
                         ):
-        paths = []
-        for month in months:
-            month_str = str(month).zfill(2)
-            if subdirs is not None:
-                for subdir in subdirs:
-                    month_files = glob.glob(f'{DATA_PATHS["wrf"]["parent"]}/{year}/{month_str}/{subdir}/{model}/*d02*00')
-                    month_files = sorted(month_files)
-                    paths.extend(month_files[6:])
-            else:
-                month_files = glob.glob(f'{DATA_PATHS["wrf"]["parent"]}/{year}/{month_str}/*/{model}/*d02*00')
-                # exclude the first 6 files as they are spinup files
-                month_files = sorted(month_files)
-                paths.extend(month_files[6:])
-        return paths
+        """
+        WRF d02 files of forecasts initialised in year (int or list) and months, from the WRF catalog
+        Args:
+            subdirs (list): only these forecasts, e.g. ['2020010100']
+        """
+        df = self.get_catalog().query(model=model)
+        # exclude lead hours 0-5 as they are spinup
+        df = df[df['lead'] >= 6]
+        df = df[df['init_time'].dt.year.isin(np.atleast_1d(year)) & df['init_time'].dt.month.isin(np.atleast_1d(months))]
+        if subdirs is not None:
+            df = df[df['init_time'].isin(pd.to_datetime(list(subdirs), format='%Y%m%d%H'))]
+        return list(df['filepath'])
+
+
+    def get_catalog(self) -> WRFCatalog:
+        if self.catalog is None:
+            self.catalog = get_wrf_catalog()
+        return self.catalog
 
     def load_ds_time(self, 
                      time,
@@ -235,91 +452,175 @@ class ProcessWRF(DataProcess):
     def kelvin_to_celsius(self, da: xr.DataArray):
         return da - 273.15
 
-    def regrid_to_topo(self, ds: xr.Dataset, topo: xr.DataArray,) -> xr.Dataset:
+    def regrid_to_topo(self, 
+                       ds: xr.Dataset, 
+                       topo: xr.DataArray, 
+                       method: str = 'bilinear',
+                       area: str = None,
+                       ) -> xr.Dataset:
+        """
+        Regrid WRF to the topography grid with xESMF, or with method='barycentric' the sparse 
+        triangulation regridder that doesn't need xESMF (see regrid_to_topo_old).
+        Only the WRF cells around the target grid are selected before regridding, see _crop_to_target.
+        Args:
+            area (str): restrict the target grid to PLOT_EXTENT[area]
+        """
+        if method == 'barycentric':
+            return self.regrid_to_topo_old(ds, topo, area=area)
 
-        hold = ds.copy()
-        hold = hold.where(hold['XLONG'] > 0, drop=True)
+        ds_out = self._target_grid(topo, area)
+        hold = self._crop_to_target(ds, ds_out)
         # hold = hold.rename({'XLONG': 'lon', 'XLAT': 'lat'})
         hold.encoding.clear()  # Clear encoding to avoid integer scaling
-
-        ds_out = xr.Dataset({
-            'latitude': (['latitude'], topo.latitude.values),
-            'longitude': (['longitude'], topo.longitude.values),
-        })
         
-        method = 'bilinear'
-        Ny_in, Nx_in = len(hold.south_north), len(hold.west_east)
-        Ny_out, Nx_out = topo['elevation'].shape
-        filename = f'{method}_{Ny_in}x{Nx_in}_{Ny_out}x{Nx_out}.nc'
-        filepath = os.path.join(DATA_PATHS['regridder_weights']['parent'], filename)
-        if os.path.exists(filepath):
-            regridder = xe.Regridder(hold.isel(Time=0), 
-                                     ds_out, 
-                                     'bilinear', 
-                                     reuse_weights=True,
-                                     filename=filepath
-                                     )
-        else:
-            regridder = xe.Regridder(hold.isel(Time=0), 
-                                     ds_out, 
-                                     'bilinear', 
-                                     reuse_weights=False,
-                                     filename=filepath
-                                     )
-            regridder.to_netcdf(filepath)
-        
-        interp_hold = regridder(hold)
+        # weights are keyed by a digest of the WRF and topography lat/lon arrays, and the regridder
+        # is kept in memory, so repeated loads in one process reuse the same sparse matrix
+        regridder = get_regridder(hold.isel(Time=0), ds_out, method)
+        interp_hold = regrid_parallel(regridder, hold, dim='Time', n_workers=self.n_workers)
         return interp_hold.rename({'Time': 'time', 'XTIME': 'time'})
 
 
-    def regrid_to_topo_old(self, ds: xr.DataArray, topo: xr.DataArray) -> xr.DataArray:
+    def _target_grid(self, topo, area: str = None) -> xr.Dataset:
+        """ Latitude and longitude of the topography grid, within PLOT_EXTENT[area] if area is set """
+        lat, lon = topo.latitude.values, topo.longitude.values
+        if area is not None:
+            extent = PLOT_EXTENT[area]
+            lat = lat[(lat >= extent['minlat']) & (lat <= extent['maxlat'])]
+            lon = lon[(lon >= extent['minlon']) & (lon <= extent['maxlon'])]
+        return xr.Dataset({
+            'latitude': (['latitude'], lat),
+            'longitude': (['longitude'], lon),
+        })
+
+
+    def _crop_to_target(self, 
+                        ds: xr.Dataset, 
+                        ds_out: xr.Dataset, 
+                        pad: int = 2,
+                        ) -> xr.Dataset:
+        """
+        Select the WRF cells covering the target grid's bounding box, grown by one cell spacing so 
+        a target smaller than a cell still selects the cells around it, plus pad cells on each side 
+        so every target point keeps its surrounding source cells. The XLONG > 0 mask is then applied 
+        to this window only rather than to the full domain.
+        """
+        xlat, xlong = ds['XLAT'], ds['XLONG']
+        if 'Time' in xlat.dims:
+            xlat, xlong = xlat.isel(Time=0), xlong.isel(Time=0)
+        xlat, xlong = xlat.values, xlong.values
+        lat, lon = ds_out['latitude'].values, ds_out['longitude'].values
+
+        # largest spacing between neighbouring valid cells, in degrees
+        valid = xlong > 0
+        dlat = self._max_spacing(np.where(valid, xlat, np.nan))
+        dlon = self._max_spacing(np.where(valid, xlong, np.nan))
+        inside = (valid
+                  & (xlat >= lat.min() - dlat) & (xlat <= lat.max() + dlat) 
+                  & (xlong >= lon.min() - dlon) & (xlong <= lon.max() + dlon))
+        if not inside.any():
+            raise ValueError('WRF domain does not overlap the target grid')
+        rows = np.flatnonzero(inside.any(axis=1))
+        cols = np.flatnonzero(inside.any(axis=0))
+        hold = ds.isel(south_north=slice(max(rows[0] - pad, 0), rows[-1] + pad + 1),
+                       west_east=slice(max(cols[0] - pad, 0), cols[-1] + pad + 1))
+        # coordinates of lazily opened files can be dask arrays, drop=True needs the mask computed
+        return hold.where((hold['XLONG'] > 0).compute(), drop=True)
+
+
+    def _max_spacing(self, values: np.ndarray) -> float:
+        """ Largest absolute difference between neighbouring values of a 2D grid along either axis, ignoring NaN """
+        diffs = [np.abs(np.diff(values, axis=axis)) for axis in (0, 1) if values.shape[axis] > 1]
+        if len(diffs) == 0 or all(np.isnan(diff).all() for diff in diffs):
+            return 0.
+        return float(max(np.nanmax(diff) for diff in diffs if not np.isnan(diff).all()))
+
+
+    def load_regridded(self,
+                       filenames: List[str],
+                       context_variables: List[str],
+                       topo: xr.Dataset,
+                       out_path: str = None,
+                       area: str = None,
+                       ) -> xr.Dataset:
         """
-        Generates a high resolution version of the field passed via data.
+        Load and regrid one forecast (directory of files) at a time, appending each regridded forecast
+        to a Zarr store, so peak memory is one forecast at native resolution however many are loaded.
+        The store is reused while the files, variables and target grid are unchanged.
+        Args:
+            filenames (list): WRF files, grouped into forecasts by directory, in the given order
+            context_variables (list): variables to load
+            topo (xr.Dataset): target grid with latitude and longitude
+            out_path (str): Zarr store, defaults to regridded_{digest}.zarr in get_regridded_dir()
+            area (str): restrict the target grid to PLOT_EXTENT[area], see regrid_to_topo
         Returns:
+            ds: regridded data opened lazily from the store
         """
-        hold = ds.copy()
-        hold = hold.where(hold['XLONG'] > 0, drop=True)
-        hold.encoding.clear()  # Clear encoding to avoid integer scaling
+        wrf_vars = [VAR_WRF[var]['var_name'] for var in context_variables]
+        digest = self._regridded_digest(filenames, wrf_vars, self._target_grid(topo, area))
+        if out_path is None:
+            out_path = f'{get_regridded_dir()}/regridded_{digest}.zarr'
+        if os.path.exists(out_path) and zarr.open_group(out_path, mode='r').attrs.get('source_digest') == digest:
+            return xr.open_zarr(out_path)
 
-        hires_lats = topo['latitude'].values
-        hires_lons = topo['longitude'].values
-        x_grid, y_grid = np.meshgrid(hires_lons, hires_lats)
+        forecasts = {}
+        for filename in filenames:
+            forecasts.setdefault(os.path.dirname(filename), []).append(filename)
 
-        times = hold['XTIME'].values
-        lats = hold['XLAT'].values[0].flatten()
-        lons = hold['XLONG'].values[0].flatten()
-
-        def _interp(values, lons, lats, new_lons, new_lats,):
-            """
-                values (_type_): values to be interpolated
-                lons (_type_): lons to be interpolated
-                lats (_type_): lats to be interpolated
-                new_lons (_type_): interp to these lons
-                new_lats (_type_): interp to these lats
-            """
-            interp = LinearNDInterpolator(list(zip(lons, lats)), values.flatten())
-            return interp(new_lons, new_lats)
-
-        def process_variable(values, var):
-            num_times = len(times)
-            x_flat, y_flat = x_grid.flatten(), y_grid.flatten()
-            partial_interp = partial(_interp, lons=lons, lats=lats, 
-                                     new_lons=x_flat, new_lats=y_flat)
-
-            vals_interp = [partial_interp(values[i]) for i in range(num_times)]
-            vals_interp = np.array(vals_interp).reshape(num_times, len(hires_lats), len(hires_lons))
-
-            return xr.DataArray(vals_interp,
-                                coords=[times, hires_lats, hires_lons],
-                                dims=['time', 'latitude', 'longitude'],
-                                name=var)
-        list_of_arrays = []
-        for var in tqdm(hold.data_vars, desc='Interpolating WRF data to topography grid'):
-            values = hold[var].values
-            list_of_arrays.append(process_variable(values, var))
-        
-        interp_hold = xr.merge(list_of_arrays)
+        partial_preprocess = lambda ds: self._preprocess_load(ds, wrf_vars)
+        for i, forecast_files in enumerate(tqdm(forecasts.values(), desc='Regridding WRF forecasts')):
+            if self.direct_read:
+                ds_regridded = self.regrid_to_topo(self.read_wrf_files(forecast_files, wrf_vars, progress=False), 
+                                                   topo, area=area)
+            else:
+                with xr.open_mfdataset(forecast_files, preprocess=partial_preprocess, concat_dim='Time',
+                                       engine='netcdf4', combine='nested') as ds:
+                    # only the source cells around the target grid are read
+                    ds_regridded = self.regrid_to_topo(ds, topo, area=area).load()
+            for var_name in ds_regridded.variables:
+                ds_regridded[var_name].encoding = {}
+            if i == 0:
+                ds_regridded.to_zarr(out_path, mode='w', consolidated=False)
+            else:
+                ds_regridded.to_zarr(out_path, append_dim='time', consolidated=False)
+
+        # written last, an interrupted run is rebuilt next time
+        zarr.open_group(out_path, mode='a').attrs['source_digest'] = digest
+        zarr.consolidate_metadata(out_path)
+        return xr.open_zarr(out_path)
 
+
+    def _regridded_digest(self, filenames, wrf_vars, topo) -> str:
+        """ Digest of the files (and their mtimes), variables and target grid of a regridded store """
+        h = hashlib.sha1(str(wrf_vars).encode())
+        for filename in filenames:
+            h.update(f'{filename}:{os.path.getmtime(filename)}'.encode())
+        for coord in ['latitude', 'longitude']:
+            h.update(np.ascontiguousarray(topo[coord].values).tobytes())
+        return h.hexdigest()
+
+
+    def regrid_to_topo_old(self, ds: xr.DataArray, topo: xr.DataArray, area: str = None) -> xr.DataArray:
+        """
+        Generates a high resolution version of the field passed via data, with linear interpolation
+        on the triangulated WRF grid (as LinearNDInterpolator). The triangulation and weights are 
+        computed once per grid pair and applied to every variable and timestep in one sparse product.
+        Returns:
+        """
+        ds_out = self._target_grid(topo, area)
+        hold = self._crop_to_target(ds, ds_out)
+        hold.encoding.clear()  # Clear encoding to avoid integer scaling
+        regridder = get_regridder(hold.isel(Time=0), ds_out, 'barycentric')
+
+        times = hold['XTIME'].values
+        variables = list(hold.data_vars)
+        values = np.stack([hold[var].values for var in variables])
+        vals_interp = regridder.regrid_array(values, n_workers=self.n_workers)
+
+        interp_hold = xr.merge([xr.DataArray(vals_interp[i],
+                                             coords=[times, ds_out.latitude.values, ds_out.longitude.values],
+                                             dims=['time', 'latitude', 'longitude'],
+                                             name=var)
+                                for i, var in enumerate(variables)])
         return interp_hold
 
     
@@ -9,7 +9,6 @@ from tqdm import tqdm
 import warnings
 from time import time
 import pickle
-import os
 
 import xarray as xr
 import pandas as pd
@@ -17,14 +16,12 @@ import numpy as np
 import matplotlib.pyplot as plt
 import cartopy.feature as cf
 from scipy.ndimage import gaussian_filter
-from sklearn.neighbors import NearestNeighbors
 
 from deepsensor.data.processor import DataProcessor
 from deepsensor.data.utils import construct_x1x2_ds
 from deepsensor.data import construct_circ_time_ds
 from nzdownscale.dataprocess import era5, wrf, stations, topography, utils, config
 from nzdownscale.dataprocess.config import LOCATION_LATLON, PLOT_EXTENT, VAR_ERA5, VAR_WRF
-from nzdownscale.dataprocess.config_local import DATA_PATHS
 
 
 class PreprocessForDownscaling:
@@ -39,11 +36,17 @@ class PreprocessForDownscaling:
                  use_daily_data=True,
                  validation = False,
                  area=None,
-                 context_variables=[]
+                 context_variables=[],
+                 compact_stations=False,
+                 stream_wrf=False,
+                 n_workers=1,
                  ) -> None:
         
         """
         use_daily_data: if True, era5 and station data will be converted to daily data
+        compact_stations: if True, station data is loaded with compact dtypes (float32 values, categorical station names)
+        stream_wrf: if True, wrf is loaded and regridded one forecast at a time into a zarr store in DATA_PATHS['cache']
+        n_workers: number of workers used to read station files, index era5 files and regrid wrf (1 runs serially)
         """
         
         self.var = variable
@@ -71,6 +74,7 @@ class PreprocessForDownscaling:
             else:
                 self.all_paths = training_fpaths + validation_fpaths
             self.years = None
+        self.stream_wrf = stream_wrf
 
         self.area = area
         
@@ -82,10 +86,10 @@ class PreprocessForDownscaling:
 
         self.process_top = topography.ProcessTopography()
         if base=='era5':
-            self.process_era = era5.ProcessERA5()
+            self.process_era = era5.ProcessERA5(n_workers=n_workers)
         elif base=='wrf':
-            self.process_wrf = wrf.ProcessWRF()
-        self.process_stations = stations.ProcessStations()
+            self.process_wrf = wrf.ProcessWRF(n_workers=n_workers)
+        self.process_stations = stations.ProcessStations(compact=compact_stations, n_workers=n_workers)
         self.nzplot = utils.PlotData()
 
         self.station_metadata_all = None
@@ -101,6 +105,7 @@ class PreprocessForDownscaling:
         self.highres_aux_ds = None
         self.landmask_ds = None
         self.station_raw_df = None
+        self.station_index = None
         self.station_df = None
 
         self._ds_elev_hr = None
@@ -210,42 +215,34 @@ class PreprocessForDownscaling:
     
     def load_era5(self):
         print('Loading era5...')
-        self.base_ds = self.process_era.load_ds(self.var, self.years)
-        if 'expver' in self.base_ds.coords:
-            self.base_ds = self.base_ds.sel(expver=1)
-            self.base_ds = self.base_ds.drop('expver')
-        for variable in self.context_variables:
-            if variable != self.var:
-                da = self.process_era.load_ds(variable, self.years)
-                self.base_ds = xr.merge([self.base_ds, da])
+        # all context variables opened lazily and merged once, so they are read together when computed
+        self.base_ds = self.process_era.load_ds_variables([self.var] + list(self.context_variables), self.years)
         
 
     def load_wrf(self):
         print('Loading wrf...')
-        base_ds = self.process_wrf.load_ds(filenames=self.all_paths,
-                                            context_variables = self.context_variables)
-        self.base_ds = self.process_wrf.regrid_to_topo(base_ds,
-                                                    self.aux_raw_ds)
+        if self.stream_wrf:
+            # bounded memory: one forecast at native resolution at a time
+            self.base_ds = self.process_wrf.load_regridded(self.all_paths,
+                                                           self.context_variables,
+                                                           self.aux_raw_ds,
+                                                           area=self.area)
+        else:
+            base_ds = self.process_wrf.load_ds(filenames=self.all_paths,
+                                                context_variables = self.context_variables)
+            self.base_ds = self.process_wrf.regrid_to_topo(base_ds,
+                                                        self.aux_raw_ds,
+                                                        area=self.area)
         times = self.base_ds.time.values
         self.years = np.unique([t.year for t in pd.to_datetime(times)])
 
     def load_stations(self, use_cache=False):
+        """
+        use_cache: keep the station metadata index on disk in DATA_PATHS['cache'], 
+        only station files that changed since the last run are re-read
+        """
         print('Loading stations...')
-
-        if use_cache:
-            if "cache" not in DATA_PATHS.keys():
-                raise ValueError("Please set 'cache' path in DATA_PATHS dict e.g. 'cache':'data/.datacache' (recommended) or set use_cache=False ")
-            savedir = f'{DATA_PATHS["cache"]}/station_data'
-            filepath = f'{savedir}/station_metadata_all.pkl'
-            if os.path.exists(filepath):
-                print(f"Loading station metadata from cache: {filepath}, set use_cache=False if you want to manually load them.")
-                self.station_metadata_all = utils.open_pickle(filepath)
-            else:
-                self.station_metadata_all = self.process_stations.get_metadata_df(self.var)
-                os.makedirs(savedir, exist_ok=True)
-                utils.save_pickle(self.station_metadata_all, filepath)
-        else:
-            self.station_metadata_all = self.process_stations.get_metadata_df(self.var)
+        self.station_metadata_all = self.process_stations.get_metadata_df(self.var, use_cache=use_cache)
 
 
     def preprocess_topography(self, 
@@ -314,13 +311,16 @@ class PreprocessForDownscaling:
         return self.base_raw_ds
 
 
-    def preprocess_stations(self, remove_stations=['None'], fill_missing=False):
-        """ Gets self.station_raw_df """
+    def preprocess_stations(self, remove_stations=['None'], fill_missing=False, min_obs=None):
+        """ 
+        Gets self.station_raw_df 
+        min_obs: with daily data, drop station days with fewer hourly observations, e.g. 24 for complete days only
+        """
 
         assert self.station_metadata_all is not None, "Run load_stations() first"
         
         self.station_metadata = self._filter_stations(self.station_metadata_all, remove_stations=remove_stations)
-        self.station_raw_df = self._get_station_raw_df(self.station_metadata, fill_missing=fill_missing)
+        self.station_raw_df = self._get_station_raw_df(self.station_metadata, fill_missing=fill_missing, min_obs=min_obs)
         
         return self.station_raw_df 
         
@@ -459,6 +459,13 @@ class PreprocessForDownscaling:
         # coarsen_factor_era = 10
         if coarsen_factor_era == 1:
             da_era_coarse = da_era
+        elif isinstance(da_era, xr.Dataset):
+            # cached coarsened levels, so sweeps over coarsen factors only compute each level once
+            if self.use_daily_data:
+                tag = f"daily_{'sum' if self.var == 'precipitation' else 'mean'}"
+            else:
+                tag = 'hourly'
+            da_era_coarse = process_era.coarsen_ds_cached(da_era, coarsen_factor_era, tag=tag)
         else:
             da_era_coarse = process_era.coarsen_da(da_era, coarsen_factor_era)
 
@@ -528,7 +535,7 @@ class PreprocessForDownscaling:
         df_filtered_years = df[condition]
 
         if area is not None:
-            df_filtered_area = df_filtered_years[(df_filtered_years['lon'] > PLOT_EXTENT[area]['minlon']) & (df_filtered_years['lon'] < PLOT_EXTENT[area]['maxlon']) & (df_filtered_years['lat'] > PLOT_EXTENT[area]['minlat']) & (df_filtered_years['lat'] < PLOT_EXTENT[area]['maxlat'])]
+            df_filtered_area = df_filtered_years[stations.StationIndex(df_filtered_years).in_area(area)]
         else:
             df_filtered_area = df_filtered_years
 
@@ -540,67 +547,36 @@ class PreprocessForDownscaling:
         return self.station_metadata_filtered
     
 
-    def _get_station_raw_df(self, df_station_metadata, fill_missing=True):
+    def _get_station_raw_df(self, df_station_metadata, fill_missing=True, min_obs=None):
 
         var = self.var
         years = self.years
 
         station_paths = list(df_station_metadata.index)
 
-        df_list = []
-        for path in tqdm(station_paths, desc='Loading filtered stations'):
-            df = self.process_stations.load_station_df(path, var, daily=self.use_daily_data)
-            df_list.append(df)
-        # print('Concatenating station data...')
-        df = pd.concat(df_list)
+        # one pass, already filtered to years
+        df = self.process_stations.load_stations_years(var, years, daily=self.use_daily_data, 
+                                                       filepaths=station_paths, min_obs=min_obs)
+        df = df.drop(columns='station_id')
         # station_raw_df = df.reset_index().set_index(['time', 
         #                                             'latitude', 
         #                                             'longitude']).sort_index()
 
-        ### filter years
         station_raw_df_ = df.reset_index()
-        station_raw_df_ = station_raw_df_[(station_raw_df_['time']>=str(years[0])) &
-                                (station_raw_df_['time']<=f'{str(years[-1])}-12-31')]
         station_raw_df = station_raw_df_.set_index(['time', 
                                                     'latitude', 
                                                     'longitude']).sort_index()
         
         if fill_missing:
-            station_raw_df = self._fill_missing_stations_with_nans(station_raw_df)
+            # every station at every time, via a dense (time x station) array that is not kept
+            station_raw_array = stations.StationArray.from_dataframe(station_raw_df)
+            del df, station_raw_df_, station_raw_df
+            self.station_index = stations.StationIndex(station_raw_array.stations)
 
-            # Fill NaNs with nearest neighbours
-            # station_raw_df = station_raw_df.groupby('time').apply(self.fill_missing_values).reset_index(drop=True)
-            station_raw_df.set_index(['time', 'latitude', 'longitude'], inplace=True)
-
-            # self.station_raw_df = station_raw_df
-            counts_per_date = station_raw_df.groupby(level='time').size()
-            assert (counts_per_date == counts_per_date[0]).all(), "Number of stations per date is not consistent"
+            station_raw_df = station_raw_array.to_dataframe()
         return station_raw_df
 
     
-    def _fill_missing_stations_with_nans(self, station_raw_df):
-        """Returns a dataframe with all combinations of times, latitudes and longitudes
-         Those without real data in station_raw_df will be filled in with nans"""
-        
-         # get all times in station_raw_df
-        times_df = pd.DataFrame({'time': station_raw_df.index.get_level_values('time').unique()})
-
-        # get all latitudes and longitudes in station_raw_df
-        lat_lon_df = pd.DataFrame(list(station_raw_df.index.droplevel(0).unique()), columns=['latitude', 'longitude'])
-        
-        # create a df with all combinations of times, latitudes and longitudes
-        all_combinations_df = pd.merge(times_df.assign(key=1), lat_lon_df.assign(key=1), on='key').drop('key', axis=1)
-
-        station_raw_df_reset = station_raw_df.reset_index()
-        # merge all_combinations_df with station_raw_df to fill in missing values
-        complete_df = pd.merge(all_combinations_df, station_raw_df_reset, on=['time', 'latitude', 'longitude'], how='left')
-        complete_df = complete_df.drop_duplicates(subset=['time', 'latitude', 'longitude'], keep='first')
-
-        #convert to datetime
-        complete_df['time'] = pd.to_datetime(complete_df['time'])
-
-        return complete_df
-
     def __str__(self):
         s = "PreprocessForDownscaling with data_processor:\n"
         s = s + self.data_processor.__str__
@@ -624,29 +600,6 @@ class PreprocessForDownscaling:
         df.drop(columns=['key'], inplace=True)
         return df
     
-    def fill_missing_values(self, group):
-        # Filter out rows where 'dry_bulb' is not NaN
-        with_data = group.dropna(subset=['dry_bulb'])
-        without_data = group[group['dry_bulb'].isna()]
-        
-        # Check if there are missing values and valid data to train on
-        if without_data.empty or with_data.empty:
-            return group
-
-        # Train NearestNeighbors on available data
-        neigh = NearestNeighbors(n_neighbors=1, metric='haversine')
-        neigh.fit(np.radians(with_data[['latitude', 'longitude']].values))
-
-        # Find nearest neighbors for NaN 'dry_bulb' entries
-        _, indices = neigh.kneighbors(np.radians(without_data[['latitude', 'longitude']].values))
-
-        # Impute missing 'dry_bulb' using the values from the nearest neighbors
-        without_data['dry_bulb'] = with_data.iloc[indices.flatten()]['dry_bulb'].values
-
-        # Combine the results back together
-        return pd.concat([with_data, without_data])
-
-
     def load_landmask(self):
         """ Land mask data array, same resolution as high res topography """ 
         assert self._ds_elev_hr is not None, "_get_highres_topography() must be run first"
@@ -22,7 +22,7 @@ from tqdm import tqdm
 
 from deepsensor.model.convnp import ConvNP
 from deepsensor.train.train import train_epoch, set_gpu_default_device
-from nzdownscale.dataprocess import config, config_local, utils
+from nzdownscale.dataprocess import config, config_local, utils, wrf
 from deepsensor.data.task import Task
 from sklearn.model_selection import train_test_split
 
@@ -305,14 +305,9 @@ class Train:
     
     def create_tasks_wrf(self, paths, context_sampling, time_intervals):
 
-        def path_to_date(path):
-            date_str = path.split('d02_')[1]
-            date = pd.to_datetime(date_str, format='%Y-%m-%d_%H:%M:%S')
-            return date
-        
         tasks = []
         for path in paths:
-            date = path_to_date(path)
+            date = wrf.parse_wrf_filename(path)['valid_time']
             if context_sampling[-1] == 'random':
                 context_sampling_ = context_sampling[:-1] + [np.random.rand()]
             
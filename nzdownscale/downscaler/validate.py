@@ -266,14 +266,10 @@ class ValidateV1:
             station_values = {}
 
         station_var = self.get_variable_name('station')
-        for location in tqdm(locations, desc='Calculating losses'):
-            # if verbose:
-            #     print(f'Calculating loss for {location}')
-            norms[location] = []
-            if return_pred:
-                pred_values[location] = []
-            if return_station:
-                station_values[location] = []
+
+        # resolve all locations to coordinates, snapping those that aren't stations to the closest station in one query
+        location_coords = []
+        for location in locations:
             if isinstance(location, str):
                 if location in STATION_LATLON:
                     X_t = self._get_location_coordinates(location, station=True)
@@ -281,10 +277,21 @@ class ValidateV1:
                     X_t = self._get_location_coordinates(location)
             else:
                 X_t = location
-
-            if location not in STATION_LATLON:
-                # Find closest station to desired target location
-                X_t = self._find_closest_station(X_t, station_raw_df)
+            location_coords.append(X_t)
+        to_snap = [i for i, location in enumerate(locations) if not (isinstance(location, str) and location in STATION_LATLON)]
+        if len(to_snap) > 0:
+            X_closest = self._find_closest_station(np.array([location_coords[i] for i in to_snap], dtype=float), station_raw_df)
+            for i, X_t in zip(to_snap, X_closest):
+                location_coords[i] = X_t
+
+        for location, X_t in tqdm(zip(locations, location_coords), total=len(locations), desc='Calculating losses'):
+            # if verbose:
+            #     print(f'Calculating loss for {location}')
+            norms[location] = []
+            if return_pred:
+                pred_values[location] = []
+            if return_station:
+                station_values[location] = []
 
             #get station values
             try:            
@@ -1165,13 +1172,20 @@ class ValidateV1:
         return X_t
 
     def _find_closest_station(self, coordinates, stations_raw_df):
-        locs = self._get_station_locations(stations_raw_df)
+        station_index = self._get_station_index(stations_raw_df)
         
-        # Find closest station to desired target location
-        X_station_closest = min(locs, key=lambda loc: np.linalg.norm(np.array(loc) - coordinates))
-        X_t = np.array(X_station_closest)
-
-        return X_t
+        # Find closest station to desired target location (or locations, one per row)
+        coordinates = np.asarray(coordinates, dtype=float)
+        X_t = station_index.nearest(coordinates[..., 0], coordinates[..., 1])
+
+        return X_t[0] if coordinates.ndim == 1 else X_t
+
+    def _get_station_index(self, stations_raw_df):
+        """ Spatial index of the stations in stations_raw_df, rebuilt only when stations_raw_df changes """
+        cached = getattr(self, '_station_index_cache', None)
+        if cached is None or cached[0] is not stations_raw_df:
+            self._station_index_cache = (stations_raw_df, stations.StationIndex.from_observations(stations_raw_df))
+        return self._station_index_cache[1]
     
     def _get_station_locations(self, stations_raw_df):
         locs = set(zip(stations_raw_df.reset_index()["latitude"], stations_raw_df.reset_index()["longitude"]))
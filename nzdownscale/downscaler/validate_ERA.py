@@ -9,7 +9,6 @@ import xarray as xr
 import torch
 import pandas as pd
 import pickle
-from tqdm import tqdm
 from datetime import datetime
 from typing import Union
 import numpy as np
@@ -173,10 +172,8 @@ class ValidateERA:
             ds = xr.merge(ds_list)
 
         if self.base == 'era5':
-            for var in tqdm(context_variables, desc=f'Loading {self.base}'):
-                base_da = self.process_era.load_ds_time(var, time)
-                ds_list.append(base_da)
-            ds = xr.merge(ds_list)
+            print(f'Loading {self.base}')
+            ds = self.process_era.load_ds_variables(context_variables, time=time)
             # precip_name = config.VAR_ERA5['precipitation']['var_name']
         
         elif self.base == 'wrf':
@@ -8,7 +8,6 @@ from deepsensor.model.convnp import ConvNP
 from deepsensor.data import construct_circ_time_ds
 
 import xarray as xr
-import glob
 import torch
 import pandas as pd
 import pickle
@@ -18,7 +17,6 @@ from typing import Union
 import numpy as np
 
 from nzdownscale.downscaler.preprocess import PreprocessForDownscaling
-from nzdownscale.dataprocess import config, config_local
 
 class ValidateWRF:
     def __init__(self,
@@ -65,6 +63,9 @@ class ValidateWRF:
         # Get topography data
         self.get_topo_data()
 
+        self.process_wrf = wrf.ProcessWRF()
+        self.station = stations.ProcessStations()
+
     
     def get_topo_data(self):
         self.top = topography.ProcessTopography()
@@ -77,18 +78,9 @@ class ValidateWRF:
         print('Producing predictions at resolution:', pred_res)
         
     def get_filepaths(self, forecast_init, forecast_end=-1, forecast_start=0, model='nz4kmN-ECMWF-SIGMA'):
-        base_dir = config_local.DATA_PATHS['wrf']['parent']
-        year = str(forecast_init.year)
-        month = str(forecast_init.month).zfill(2)
-        day = str(forecast_init.day).zfill(2)
-        hour = str(forecast_init.hour).zfill(2)
-
-        subdir = f'{year}{month}{day}{hour}'
-
-        path = f'{base_dir}/{year}/{month}/{subdir}/{model}/'
-
-        all_files = glob.glob(f'{path}/*d02*00')
-        all_files.sort()
+        # d02 files of this forecast from the WRF catalog, in lead order
+        df = self.process_wrf.get_catalog().query(init_times=[forecast_init], model=model)
+        all_files = list(df['filepath'])
 
         return all_files[forecast_start:forecast_end]
     
@@ -110,9 +102,6 @@ class ValidateWRF:
         Returns:
             ds (xr.Dataset): WRF data processed and ready for prediction
         """
-        # Instantiate wrf process class
-        self.process_wrf = wrf.ProcessWRF()
-
         if filepaths is None:
             # Get filepaths
             assert forecast_init is not None, 'forecast_init or paths must be provided'
@@ -134,7 +123,6 @@ class ValidateWRF:
         return ds
     
     def load_stations(self, times, remove_stations=[], keep_stations=[]):
-        self.station = stations.ProcessStations()
         stations_df = self.station.load_stations_time(self.variable, 
                                                 times, 
                                                 remove_stations, 